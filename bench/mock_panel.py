@@ -0,0 +1,201 @@
+import re
+import json
+import random
+import asyncio
+from urllib.parse import parse_qs
+
+_ID_SEGMENT = re.compile(r"/(\d+|[0-9a-fA-F-]{36})(?=/|$)")
+
+
+class MockXUIPanel:
+    # ASGI-приложение с эндпоинтами 3x-ui, которыми пользуется бот; подключается через httpx.ASGITransport
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, api_prefix="", seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.api_prefix = api_prefix.strip("/")
+        self.random = random.Random(seed)
+        self.inbounds = {}
+        self.next_id = 1
+        self.requests = {}
+        self._client_inbound = {}
+        self._ports = {}
+        self._listing = None
+
+    def add_inbound(self, port, clients=(), remark=""):
+        inbound = {
+            "id": self.next_id,
+            "remark": remark,
+            "enable": True,
+            "port": port,
+            "protocol": "vless",
+            "expiryTime": 0,
+            "settings": {"clients": list(clients), "decryption": "none"},
+            "streamSettings": {"network": "tcp", "security": "tls"},
+            "sniffing": {"enabled": True},
+        }
+        self._store(inbound)
+        self.next_id += 1
+        self._listing = None
+        return inbound
+
+    def _store(self, inbound):
+        previous = self.inbounds.get(inbound["id"])
+        if previous is not None:
+            self._unindex(previous)
+        self.inbounds[inbound["id"]] = inbound
+        self._ports[inbound.get("port")] = inbound["id"]
+        for client in inbound["settings"].get("clients", []):
+            self._client_inbound[client["id"]] = inbound["id"]
+
+    def _unindex(self, inbound):
+        if self._ports.get(inbound.get("port")) == inbound["id"]:
+            del self._ports[inbound.get("port")]
+        for client in inbound["settings"].get("clients", []):
+            if self._client_inbound.get(client["id"]) == inbound["id"]:
+                del self._client_inbound[client["id"]]
+
+    @staticmethod
+    def make_client(client_id, email, traffic_gb=40, expiry_ms=0):
+        return {
+            "id": client_id, "flow": "xtls-rprx-vision", "email": email,
+            "limitIp": 0, "totalGB": traffic_gb, "expiryTime": expiry_ms, "enable": True
+        }
+
+    def client_count(self):
+        return sum(len(inbound["settings"]["clients"]) for inbound in self.inbounds.values())
+
+    def _render(self, inbound):
+        rendered = dict(inbound)
+        for key in ("settings", "streamSettings", "sniffing"):
+            rendered[key] = json.dumps(inbound[key])
+        rendered["clientStats"] = [
+            {"email": c["email"], "up": 0, "down": 0, "enable": c.get("enable", True)}
+            for c in inbound["settings"]["clients"]
+        ]
+        return rendered
+
+    def _list(self):
+        # Сериализованный список кэшируется до следующего изменения, как это делает сама панель
+        if self._listing is None:
+            self._listing = json.dumps(
+                {"success": True, "msg": "", "obj": [self._render(i) for i in self.inbounds.values()]}
+            ).encode()
+        return self._listing
+
+    @staticmethod
+    def _parse(inbound):
+        for key in ("settings", "streamSettings", "sniffing"):
+            if isinstance(inbound.get(key), str):
+                inbound[key] = json.loads(inbound[key]) if inbound[key] else {}
+        return inbound
+
+    def _find_client(self, uuid):
+        inbound = self.inbounds.get(self._client_inbound.get(uuid))
+        if inbound is None:
+            return None, None
+        for index, client in enumerate(inbound["settings"]["clients"]):
+            if client["id"] == uuid:
+                return inbound, index
+        return None, None
+
+    def handle(self, path, body):
+        if path == "/login":
+            return {"success": True, "msg": "Login Successfully"}
+        if not path.startswith("/panel/api/inbounds/"):
+            return None
+        parts = path[len("/panel/api/inbounds/"):].split("/")
+
+        if parts == ["list"]:
+            return self._list()
+
+        self._listing = None
+        if parts == ["add"]:
+            inbound = self._parse(body)
+            if inbound.get("port") in self._ports:
+                return {"success": False, "msg": "Port already exists"}
+            inbound["id"] = self.next_id
+            self.next_id += 1
+            self._store(inbound)
+            return {"success": True, "msg": "", "obj": self._render(inbound)}
+
+        if len(parts) == 2 and parts[0] in ("update", "del") and parts[1].isdigit():
+            inbound_id = int(parts[1])
+            if inbound_id not in self.inbounds:
+                return {"success": False, "msg": "Inbound not found"}
+            if parts[0] == "del":
+                self._unindex(self.inbounds.pop(inbound_id))
+                return {"success": True, "msg": ""}
+            inbound = self._parse(body)
+            inbound["id"] = inbound_id
+            self._store(inbound)
+            return {"success": True, "msg": ""}
+
+        if parts == ["addClient"]:
+            inbound = self.inbounds.get(int(body.get("id", 0)))
+            if inbound is None:
+                return {"success": False, "msg": "Inbound not found"}
+            clients = json.loads(body["settings"])["clients"]
+            emails = {c["email"] for c in inbound["settings"]["clients"]}
+            if any(c["email"] in emails for c in clients):
+                return {"success": False, "msg": "Duplicate email"}
+            inbound["settings"]["clients"].extend(clients)
+            for client in clients:
+                self._client_inbound[client["id"]] = inbound["id"]
+            return {"success": True, "msg": ""}
+
+        if len(parts) == 2 and parts[0] == "updateClient":
+            inbound, index = self._find_client(parts[1])
+            if inbound is None:
+                return {"success": False, "msg": "Client not found"}
+            inbound["settings"]["clients"][index] = json.loads(body["settings"])["clients"][0]
+            return {"success": True, "msg": ""}
+
+        if len(parts) == 3 and parts[1] == "delClient" and parts[0].isdigit():
+            inbound = self.inbounds.get(int(parts[0]))
+            if inbound is None:
+                return {"success": False, "msg": "Inbound not found"}
+            inbound["settings"]["clients"] = [c for c in inbound["settings"]["clients"] if c["id"] != parts[2]]
+            self._client_inbound.pop(parts[2], None)
+            return {"success": True, "msg": ""}
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        # Бот собирает URL как {panel_url}/{api_prefix}{endpoint}, без префикса получается "//"
+        path = re.sub(r"/+", "/", scope["path"])
+        if self.api_prefix and path.startswith(f"/{self.api_prefix}"):
+            path = path[len(self.api_prefix) + 1:]
+        label = _ID_SEGMENT.sub("/{id}", path)
+        self.requests[label] = self.requests.get(label, 0) + 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            status, payload = 500, b'{"success": false, "msg": "Internal Server Error"}'
+        else:
+            try:
+                data = json.loads(body) if body else {}
+            except json.JSONDecodeError:
+                data = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            result = self.handle(path, data)
+            if result is None:
+                status, payload = 404, b'{"success": false, "msg": "Not Found"}'
+            else:
+                status = 200
+                payload = result if isinstance(result, bytes) else json.dumps(result).encode()
+
+        headers = [(b"content-type", b"application/json")]
+        if path == "/login":
+            headers.append((b"set-cookie", b"3x-ui=mock-session; Path=/"))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": payload})
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import math
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import httpx
+from bench.mock_panel import MockXUIPanel
+
+NODE = "bench"
+GB = 1024 ** 3
+
+
+class FakeMessage:
+    def __init__(self, replies):
+        self.replies = replies
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeCallbackQuery:
+    def __init__(self, user, replies):
+        self.from_user = user
+        self.replies = replies
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def command_update(user_id, replies):
+    user = SimpleNamespace(id=user_id, username=f"bench{user_id}", first_name="Bench")
+    message = FakeMessage(replies)
+    return SimpleNamespace(
+        effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+        message=message, effective_message=message, callback_query=None
+    )
+
+
+def callback_update(user_id, replies):
+    user = SimpleNamespace(id=user_id, username=f"bench{user_id}", first_name="Bench")
+    message = FakeMessage(replies)
+    return SimpleNamespace(
+        effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+        message=None, effective_message=message, callback_query=FakeCallbackQuery(user, replies)
+    )
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+async def measure(handler, make_update, user_ids, concurrency):
+    latencies = []
+    errors = 0
+    pending = iter(user_ids)
+
+    async def worker():
+        nonlocal errors
+        for user_id in pending:
+            replies = []
+            started = time.perf_counter()
+            try:
+                await handler(make_update(user_id, replies), None)
+                ok = bool(replies) and not any(r.startswith(("❌", "⏳")) for r in replies)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "ops_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def seed(args, panel, database):
+    # Пользователи создаются напрямую в БД и в панели, минуя бота: замеряются только операции
+    now = int(time.time())
+    rows = []
+    clients = []
+    for user_id in range(1, args.single + 1):
+        client_id = str(uuid.UUID(int=user_id))
+        rows.append((user_id, f"bench{user_id}", client_id, 40 * GB, 0, now + 30 * 86400, 1, NODE))
+        clients.append(panel.make_client(client_id, f"user_{user_id}_{client_id[:8]}@vpn.com", 40, (now + 30 * 86400) * 1000))
+
+    with database.conn as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, uuid, traffic_limit, traffic_used, expire_date, is_active, node, "
+            "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))",
+            rows
+        )
+
+    if args.mode == "shared":
+        # Запас ёмкости под новые регистрации — в последнем inbound
+        count = math.ceil((args.single + args.ops) / args.capacity) + 1
+        shared = []
+        for i in range(count):
+            chunk = clients[i * args.capacity:(i + 1) * args.capacity]
+            shared.append(panel.add_inbound(20000 + i, chunk, remark=f"shared-{i}")["id"])
+        return shared
+
+    panel.add_inbound(20000, remark="template")
+    for i, client in enumerate(clients):
+        panel.add_inbound(args.port_start + i, [client], remark=client["email"])
+    return None
+
+
+def bench_config(args, shared_inbounds, workdir):
+    node = {"name": NODE, "url": "http://mock-xui", "username": "admin", "password": "admin"}
+    if shared_inbounds:
+        node["shared_inbounds"] = shared_inbounds
+        node["shared_capacity"] = args.capacity
+    return {
+        "BOT_TOKEN": "0:bench",
+        "ADMIN_IDS": [],
+        "TRIAL_TRAFFIC_GB": 10,
+        "TRIAL_DAYS": 3,
+        "XUI_NODES": [node],
+        "XUI_PORT_START": args.port_start,
+        "XUI_PORT_END": 65000,
+        "METRICS_PORT": 0,
+        "LOG_LEVEL": "WARNING",
+        "LOG_FILE": os.path.join(workdir, "bench.log"),
+        "DB_PATH": os.path.join(workdir, "vpn_bot.db"),
+        "SIGNUP_QUEUE_SIZE": max(1000, args.concurrency * 2),
+        # Замеряется сам обработчик: общий бюджет запросов к панели не должен отклонять регистрации
+        "PANEL_RATE": 1_000_000,
+        "PANEL_BURST": 1_000_000,
+        "OUTBOX_FLUSH_INTERVAL": args.flush_interval,
+    }
+
+
+async def run_single(args):
+    workdir = tempfile.mkdtemp(prefix="vpn-bench-")
+    panel = MockXUIPanel(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+
+    from database import Database
+    started = time.perf_counter()
+    database = Database(os.path.join(workdir, "vpn_bot.db"))
+    shared_inbounds = seed(args, panel, database)
+    database.close()
+    seeded = time.perf_counter() - started
+
+    import bot
+    bot.setup(bench_config(args, shared_inbounds, workdir), transport=httpx.ASGITransport(app=panel))
+    await bot.post_init(SimpleNamespace(bot=None))
+    # Обработчики начинают работать сразу, но замеряем уже прогретого бота
+    await bot.warmup.wait_ready()
+    ready = time.monotonic() - bot.warmup.started
+
+    rng = random.Random(args.seed)
+    existing = [rng.randint(1, args.single) for _ in range(args.ops)]
+    new_users = range(args.single + 1, args.single + args.ops + 1)
+
+    results = {"users": args.single, "mode": args.mode, "seed_s": round(seeded, 2), "ready_s": round(ready, 2),
+               "cached_users": len(bot.db.cache)}
+    results["signup"] = await measure(bot.start, command_update, new_users, args.concurrency)
+    results["stats"] = await measure(bot.stats, callback_update, existing, args.concurrency)
+    results["renew"] = await measure(bot.renew_basic, callback_update, existing, args.concurrency)
+    # Продление отвечает сразу, в панель изменения доходят через очередь — замеряем, когда она опустеет
+    started = time.perf_counter()
+    while (await bot.db.get_panel_outbox_stats())[0]:
+        await asyncio.sleep(0.05)
+    results["outbox_drain_s"] = round(time.perf_counter() - started, 2)
+    report = await bot.reconciler.run(apply=False)
+    results["reconcile_s"] = round(report["duration"], 2)
+    results["reconcile_diffs"] = sum(len(report[k]) for k in ("orphans", "missing", "mismatched", "duplicates"))
+    results["panel_requests"] = dict(panel.requests)
+
+    await bot.post_shutdown(None)
+    print(json.dumps(results))
+
+
+def run_all(args):
+    results = []
+    for users in args.users:
+        # Каждый масштаб — в отдельном процессе: setup() заполняет глобальное состояние модуля bot
+        command = [sys.executable, "-m", "bench.run", "--single", str(users)]
+        for name in ("ops", "concurrency", "mode", "capacity", "port_start", "latency", "jitter",
+                     "error_rate", "flush_interval", "seed"):
+            command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+        completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"Прогон на {users} пользователей завершился ошибкой:\n{completed.stderr[-2000:]}", file=sys.stderr)
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    for result in results:
+        print(f"{result['users']} пользователей: готов за {result['ready_s']} с, "
+              f"в кэше {result['cached_users']}, очередь панели разобрана за {result['outbox_drain_s']} с, "
+              f"сверка за {result['reconcile_s']} с (расхождений {result['reconcile_diffs']})")
+    print(f"{'users':>8} {'op':<8} {'ops':>6} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>9}")
+    for result in results:
+        for op in ("signup", "stats", "renew"):
+            r = result[op]
+            print(f"{result['users']:>8} {op:<8} {r['ops']:>6} {r['errors']:>6} "
+                  f"{r['p50_ms']:>9} {r['p99_ms']:>9} {r['ops_per_s']:>9}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота на имитации панели 3x-ui")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--ops", type=int, default=1000, help="операций каждого вида на прогон")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mode", choices=("shared", "inbound"), default="shared",
+                        help="shared — клиенты в общих inbound, inbound — отдельный inbound на пользователя")
+    parser.add_argument("--capacity", type=int, default=2000, help="клиентов на общий inbound")
+    parser.add_argument("--port-start", type=int, default=21000)
+    parser.add_argument("--latency", type=float, default=0.02, help="средняя задержка панели, с")
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    scales = [args.single] if args.single is not None else args.users
+    if args.mode == "inbound" and max(scales) + args.ops > 65000 - args.port_start:
+        parser.error("в режиме inbound пользователей больше, чем свободных портов")
+    if args.single is not None:
+        asyncio.run(run_single(args))
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
-
 import os
 import json
+import time
+import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
@@ -10,41 +11,128 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes
 )
-import xui_api
-from database import Database
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('vpn_bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from node_pool import NodePool
+from database import Database, AsyncDatabase
+from user_cache import UserCache
+from traffic_sync import TrafficSync
+from traffic_history import TrafficHistory
+from enforcement import EnforcementSweep
+from broadcast import Broadcaster
+from signup import SignupPipeline
+from renewal import Renewals
+from outbox import PanelOutbox
+from reconcile import Reconciler
+from server_stats import StatsSampler
+from warmup import Warmup
+import metrics
+from logging_setup import setup_logging
+from webhook import run_webhook
+from rate_limit import TokenBucket, UserRateLimiter, CallbackThrottle
+
 logger = logging.getLogger(__name__)
 
-# Загрузка конфигурации
-try:
-    with open('config.json') as f:
-        config = json.load(f)
+# Заполняются в setup(): импорт модуля не читает конфигурацию, не открывает БД и не ходит в сеть
+config = None
+log_handler = None
+db = pool = traffic_history = traffic_sync = enforcement = broadcaster = signup = renewals = outbox = None
+server_stats = throttle = loop_lag = metrics_server = warmup = reconciler = None
+
+def load_config(path='config.json'):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        setup_logging({})
+        logger.critical("Ошибка загрузки конфигурации: %s", e)
+        raise
+
+def setup(loaded_config, transport=None):
+    # transport подменяет HTTP-транспорт клиентов панели (нагрузочный прогон на имитации 3x-ui)
+    global config, log_handler, db, pool, traffic_history, traffic_sync, enforcement, broadcaster, signup
+    global renewals, outbox, server_stats, throttle, loop_lag, metrics_server, warmup, reconciler
+    started = time.monotonic()
+    config = loaded_config
+    log_handler = setup_logging(config)
     logger.info("Конфигурация успешно загружена")
-except Exception as e:
-    logger.critical(f"Ошибка загрузки конфигурации: {str(e)}")
-    raise
-
-# Инициализация базы данных и X-UI API
-try:
-    db = Database('vpn_bot.db')
-    xui = xui_api.XUIAPI(
-        config['XUI_PANEL_URL'],
-        config['XUI_USERNAME'],
-        config['XUI_PASSWORD'],
-        config.get('XUI_API_PREFIX', '')
-    )
-    logger.info("База данных и X-UI API инициализированы")
-except Exception as e:
-    logger.critical(f"Ошибка инициализации: {str(e)}")
-    raise
+
+    try:
+        db = AsyncDatabase(
+            Database(config.get('DB_PATH', 'vpn_bot.db')),
+            max_workers=config.get('DB_WORKERS', 4),
+            cache=UserCache(
+                max_size=config.get('USER_CACHE_SIZE', 10000),
+                ttl=config.get('USER_CACHE_TTL', 300)
+            )
+        )
+        pool = NodePool.from_config(config, transport=transport)
+        traffic_history = TrafficHistory(
+            db.db,
+            raw_retention=config.get('TRAFFIC_RAW_RETENTION', 6 * 3600),
+            hourly_retention=config.get('TRAFFIC_HOURLY_RETENTION', 7 * 86400),
+            daily_retention=config.get('TRAFFIC_DAILY_RETENTION', 365 * 86400)
+        )
+        traffic_sync = TrafficSync(db, pool, traffic_history)
+        outbox = PanelOutbox(
+            db, pool,
+            batch_size=config.get('OUTBOX_BATCH_SIZE', 1000),
+            flush_interval=config.get('OUTBOX_FLUSH_INTERVAL', 0.5),
+            poll_interval=config.get('OUTBOX_POLL_INTERVAL', 5),
+            backoff_max=config.get('OUTBOX_BACKOFF_MAX', 300)
+        )
+        enforcement = EnforcementSweep(
+            db, pool, outbox,
+            batch_size=config.get('ENFORCEMENT_BATCH_SIZE', 500),
+            concurrency=config.get('ENFORCEMENT_CONCURRENCY', 5)
+        )
+        broadcaster = Broadcaster(db, rate=config.get('BROADCAST_RATE', 25))
+        signup = SignupPipeline(
+            db, pool, outbox,
+            traffic_gb=config['TRIAL_TRAFFIC_GB'],
+            days=config['TRIAL_DAYS'],
+            workers=config.get('SIGNUP_WORKERS', 8),
+            queue_size=config.get('SIGNUP_QUEUE_SIZE', 1000)
+        )
+        renewals = Renewals(db, outbox)
+        reconciler = Reconciler(
+            db, pool, outbox,
+            batch_size=config.get('RECONCILE_BATCH_SIZE', 500),
+            batch_rate=config.get('RECONCILE_BATCH_RATE', 1),
+            max_deletes=config.get('RECONCILE_MAX_DELETES', 100),
+            auto_apply=config.get('RECONCILE_AUTO_APPLY', False)
+        )
+        server_stats = StatsSampler(
+            pool,
+            history=config.get('STATS_HISTORY', 60),
+            top_n=config.get('STATS_TOP_N', 5)
+        )
+        throttle = CallbackThrottle(
+            UserRateLimiter(
+                rate=config.get('CALLBACK_RATE', 1),
+                capacity=config.get('CALLBACK_BURST', 5),
+                max_users=config.get('RATE_LIMIT_USERS', 10000)
+            ),
+            TokenBucket(rate=config.get('PANEL_RATE', 20), capacity=config.get('PANEL_BURST', 40))
+        )
+        loop_lag = metrics.LoopLagMonitor(config.get('LOOP_LAG_INTERVAL', 0.5))
+        metrics_server = (
+            metrics.MetricsServer(config.get('METRICS_HOST', '127.0.0.1'), config.get('METRICS_PORT', 9100))
+            if config.get('METRICS_PORT', 9100) else None
+        )
+        warmup = Warmup(db, pool, signup, started=started, page_size=config.get('WARMUP_PAGE_SIZE', 1000))
+        metrics.watch_cache(db.cache)
+        metrics.watch_nodes(pool)
+        metrics.LOG_DROPPED.set_function(lambda: log_handler.dropped)
+        metrics.OUTBOX_DEPTH.set_function(lambda: outbox.depth)
+        metrics.OUTBOX_AGE.set_function(outbox.age)
+        logger.info("База данных и X-UI API инициализированы")
+    except Exception as e:
+        logger.critical("Ошибка инициализации: %s", e)
+        raise
+
+STARTING_TEXT = "⏳ Сервис запускается, попробуйте через несколько секунд"
+
+def is_admin(user_id: int):
+    return str(user_id) in config['ADMIN_IDS']
 
 def get_main_keyboard(user_id: int):
     keyboard = [
@@ -52,7 +140,7 @@ def get_main_keyboard(user_id: int):
         [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")],
         [InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")]
     ]
-    if str(user_id) in config['ADMIN_IDS']:
+    if is_admin(user_id):
         keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_menu")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -63,50 +151,47 @@ def append_back_button(keyboard):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
-    logger.info(f"Команда /start от пользователя {user_id}")
+    logger.info("Команда /start от пользователя %s", user_id)
 
-    if not db.user_exists(user_id):
-        if not xui.check_connection():
+    if not await db.user_exists(user_id):
+        # До подключения к панели регистрации не принимаются: конвейер ещё не запущен
+        if not warmup.panel_ready:
+            await update.message.reply_text(STARTING_TEXT)
+            return
+        # Продление пишет только в БД, к панели напрямую обращается лишь регистрация
+        if not throttle.allow_panel():
+            await update.message.reply_text("⏳ Сервер перегружен, попробуйте через минуту")
+            return
+        status, config_link = await signup.signup(user_id, user.username)
+        if status == "busy":
+            await update.message.reply_text("⏳ Слишком много регистраций, попробуйте через минуту")
+            return
+        if status == "unavailable":
             await update.message.reply_text("❌ Ошибка подключения к серверу VPN")
             return
-
-        result = xui.create_user(
-            remark=f"user_{user_id}",
-            traffic_gb=config['TRIAL_TRAFFIC_GB'],
-            expire_days=config['TRIAL_DAYS']
-        )
-
-        if not result:
+        if status == "failed":
             await update.message.reply_text("❌ Ошибка при создании VPN-профиля")
             return
-
-        uuid, port = result
-        db.create_user(
-            user_id=user_id,
-            username=user.username,
-            uuid=uuid,
-            traffic_limit=config['TRIAL_TRAFFIC_GB'] * 1024 ** 3,
-            expire_date=(datetime.now() + timedelta(days=config['TRIAL_DAYS'])).strftime('%Y-%m-%d')
-        )
-        config_link = xui.generate_config(uuid, port)
-        await update.message.reply_text(
-            f"🎉 Ваш VPN-доступ активирован!\n\n"
-            f"🔑 Конфигурация:\n<code>{config_link}</code>",
-            parse_mode="HTML"
-        )
+        if status == "created":
+            await update.message.reply_text(
+                f"🎉 Ваш VPN-доступ активирован!\n\n"
+                f"🔑 Конфигурация:\n<code>{config_link}</code>",
+                parse_mode="HTML"
+            )
     await show_main_menu(update, context)
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     if not user_data:
         await update.message.reply_text("❌ Данные не найдены")
         return
     if not user_data['is_active']:
-        await update.message.reply_text("❌ Аккаунт деактивирован")
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Продлить подписку", callback_data="renew")]])
+        await update.effective_message.reply_text("❌ Аккаунт деактивирован", reply_markup=keyboard)
         return
 
-    expire_date = datetime.strptime(user_data['expire_date'], '%Y-%m-%d')
+    expire_date = datetime.fromtimestamp(user_data['expire_date'])
     remaining_days = max(0, (expire_date - datetime.now()).days)
     remaining_traffic_gb = max(0, (user_data['traffic_limit'] - user_data['traffic_used']) // (1024 ** 3))
 
@@ -139,17 +224,18 @@ async def renew_basic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     if not user_data:
         await query.edit_message_text("❌ Пользователь не найден")
         return
 
-    expire_date = datetime.strptime(user_data['expire_date'], '%Y-%m-%d')
-    new_expire = expire_date + timedelta(days=30)
-    new_traffic = user_data['traffic_limit'] + 40 * 1024**3
-    db.update_user(user_id, traffic_limit=new_traffic, expire_date=new_expire.strftime('%Y-%m-%d'))
-    xui.update_user(uuid=user_data['uuid'], traffic_gb=new_traffic // (1024**3), expire_days=30)
+    result = await renewals.renew(user_data, days=30, extra_gb=40)
+    if result is None:
+        await query.edit_message_text("❌ Ошибка продления подписки")
+        return
 
+    expire_date, new_traffic = result
+    new_expire = datetime.fromtimestamp(expire_date)
     await query.edit_message_text(
         f"✅ Подписка продлена!\n\n"
         f"📅 До: {new_expire.strftime('%d.%m.%Y')}\n"
@@ -160,32 +246,200 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id)
     if not user_data:
         await query.edit_message_text("❌ Пользователь не найден")
         return
 
-    expire_date = datetime.strptime(user_data['expire_date'], '%Y-%m-%d')
+    expire_date = datetime.fromtimestamp(user_data['expire_date'])
     remaining_days = (expire_date - datetime.now()).days
     traffic_used = user_data['traffic_used'] // (1024 ** 3)
     traffic_limit = user_data['traffic_limit'] // (1024 ** 3)
+    daily = await db.run(traffic_history.daily_usage, user_id, int(time.time()) - 6 * 86400)
 
-    await query.edit_message_text(
+    text = (
         f"📊 Ваша статистика:\n\n"
         f"🆔 @{user_data['username']}\n"
         f"📅 До: {expire_date.strftime('%d.%m.%Y')} ({remaining_days} дн.)\n"
         f"📶 Трафик: {traffic_used}/{traffic_limit} ГБ"
     )
+    if daily:
+        text += "\n\n📈 По дням:\n" + "\n".join(
+            f"{datetime.fromtimestamp(bucket).strftime('%d.%m')} — {used / 1024 ** 3:.2f} ГБ"
+            for bucket, used in daily
+        )
+    await query.edit_message_text(text)
+
+async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(query.from_user.id):
+        return
+    reply_markup = append_back_button([])
+    await query.edit_message_text(
+        f"👑 Админ-панель\n\n{server_stats.render()}\n"
+        f"📤 Очередь панели: {outbox.depth} (старейшее {outbox.age():.0f} с)\n\n"
+        "📢 /broadcast <текст> — рассылка всем пользователям\n"
+        "⛔ /broadcast_stop <номер> — остановить рассылку\n"
+        "⏩ /extend_all <дней> — продлить всех активных пользователей\n"
+        "🔝 /top_traffic [часов] — лидеры по трафику\n"
+        "🔍 /reconcile [apply] — сверка БД и панели",
+        reply_markup=reply_markup
+    )
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("Использование: /broadcast <текст>")
+        return
+    await broadcaster.start(context.bot, text, update.effective_user.id, update.effective_chat.id)
+
+async def broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_stop <номер>")
+        return
+    if broadcaster.cancel(int(context.args[0])):
+        await update.message.reply_text("⛔ Рассылка останавливается")
+    else:
+        await update.message.reply_text("❌ Активная рассылка с таким номером не найдена")
+
+async def extend_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit() or int(context.args[0]) <= 0:
+        await update.message.reply_text("Использование: /extend_all <дней>")
+        return
+    days = int(context.args[0])
+    count = await renewals.extend_all(days)
+    if count is None:
+        await update.message.reply_text("❌ Ошибка массового продления")
+        return
+    await update.message.reply_text(
+        f"✅ Продлено пользователей: {count}\n"
+        "⏳ Изменения применяются в панели в фоне"
+    )
+
+async def top_traffic(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    hours = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    now = int(time.time())
+    rows = await db.run(traffic_history.top_users, now - hours * 3600, now, config.get('TOP_TRAFFIC_LIMIT', 10))
+    if not rows:
+        await update.message.reply_text(f"📭 Нет трафика за {hours} ч.")
+        return
+    await update.message.reply_text(
+        f"🔝 Лидеры по трафику за {hours} ч.:\n" + "\n".join(
+            f"{i}. {user_id} — {used / 1024 ** 3:.2f} ГБ" for i, (user_id, used) in enumerate(rows, 1)
+        )
+    )
+
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    apply = bool(context.args) and context.args[0] == "apply"
+    await update.message.reply_text("⏳ Сверка БД и панели...")
+    report = await reconciler.run(apply=apply)
+    if report is None:
+        await update.message.reply_text("❌ Сверка не выполнена: панель недоступна")
+        return
+    await update.message.reply_text(reconciler.render(report))
+
+async def prune_traffic_history(context: ContextTypes.DEFAULT_TYPE):
+    await db.run(traffic_history.prune, int(time.time()))
+
+async def post_init(application):
+    loop_lag.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    outbox.start()
+    await broadcaster.resume(application.bot)
+    # Панель и кэши прогреваются в фоне: приложение начинает принимать обновления сразу
+    warmup.start()
+
+async def post_shutdown(application):
+    await warmup.stop()
+    await signup.stop()
+    await outbox.stop()
+    await broadcaster.shutdown()
+    await pool.close()
+    await db.close()
+    await loop_lag.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
 
 def main():
-    application = ApplicationBuilder().token(config['BOT_TOKEN']).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(back_to_menu, pattern="^back_menu$"))
-    application.add_handler(CallbackQueryHandler(renew, pattern="^renew$"))
-    application.add_handler(CallbackQueryHandler(renew_basic, pattern="^renew_basic$"))
-    application.add_handler(CallbackQueryHandler(stats, pattern="^stats$"))
+    setup(load_config())
+    webhook_mode = config.get('UPDATE_MODE', 'polling') == 'webhook'
+    builder = (
+        ApplicationBuilder()
+        .token(config['BOT_TOKEN'])
+        .concurrent_updates(config.get('CONCURRENT_UPDATES', 256))
+        # Ограниченная очередь: при webhook переполнение отдаётся Telegram как 503, при polling — тормозит getUpdates
+        .update_queue(asyncio.Queue(maxsize=config.get('UPDATE_QUEUE_SIZE', 1000)))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if webhook_mode:
+        builder = builder.updater(None)
+    application = builder.build()
+    metrics.UPDATE_QUEUE_DEPTH.set_function(application.update_queue.qsize)
+    application.add_handler(CommandHandler("start", metrics.instrument(start)))
+    application.add_handler(CallbackQueryHandler(metrics.instrument(throttle.wrap(back_to_menu)), pattern="^back_menu$"))
+    application.add_handler(CallbackQueryHandler(metrics.instrument(throttle.wrap(renew)), pattern="^renew$"))
+    application.add_handler(CallbackQueryHandler(metrics.instrument(throttle.wrap(renew_basic)), pattern="^renew_basic$"))
+    application.add_handler(CallbackQueryHandler(metrics.instrument(throttle.wrap(stats)), pattern="^stats$"))
+    application.add_handler(CallbackQueryHandler(metrics.instrument(throttle.wrap(admin_menu)), pattern="^admin_menu$"))
+    application.add_handler(CommandHandler("broadcast", metrics.instrument(broadcast)))
+    application.add_handler(CommandHandler("broadcast_stop", metrics.instrument(broadcast_stop)))
+    application.add_handler(CommandHandler("extend_all", metrics.instrument(extend_all)))
+    application.add_handler(CommandHandler("top_traffic", metrics.instrument(top_traffic)))
+    application.add_handler(CommandHandler("reconcile", metrics.instrument(reconcile)))
+    application.job_queue.run_repeating(
+        pool.check_health,
+        interval=config.get('HEALTH_CHECK_INTERVAL', 60),
+        first=10,
+        name="health_check"
+    )
+    application.job_queue.run_repeating(
+        traffic_sync.run,
+        interval=config.get('TRAFFIC_SYNC_INTERVAL', 300),
+        first=30,
+        name="traffic_sync"
+    )
+    application.job_queue.run_repeating(
+        enforcement.run,
+        interval=config.get('ENFORCEMENT_INTERVAL', 600),
+        first=60,
+        name="enforcement"
+    )
+    application.job_queue.run_repeating(
+        prune_traffic_history,
+        interval=config.get('TRAFFIC_PRUNE_INTERVAL', 3600),
+        first=120,
+        name="traffic_history_prune"
+    )
+    application.job_queue.run_repeating(
+        server_stats.run,
+        interval=config.get('STATS_INTERVAL', 60),
+        first=5,
+        name="server_stats"
+    )
+    application.job_queue.run_repeating(
+        reconciler.run,
+        interval=config.get('RECONCILE_INTERVAL', 3600),
+        first=600,
+        name="reconcile"
+    )
     logger.info("Бот запущен")
-    application.run_polling()
+    if webhook_mode:
+        asyncio.run(run_webhook(application, config, post_init, post_shutdown))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+import logging
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError, TelegramError
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    def __init__(self, db, rate=25, chunk_size=25, max_retries=3, progress_interval=5):
+        self.db = db
+        # Общий лимит Telegram ~30 сообщений/с на бота; каждому получателю уходит одно сообщение,
+        # так что лимит на чат (1 сообщение/с) соблюдается сам собой
+        self.bucket = TokenBucket(rate)
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self._tasks = {}
+        self._cancelled = set()
+
+    async def start(self, bot, text, admin_id, chat_id):
+        status = await bot.send_message(chat_id, "📢 Рассылка запускается...")
+        broadcast_id = await self.db.create_broadcast(text, admin_id, chat_id, status.message_id)
+        if broadcast_id is None:
+            await status.edit_text("❌ Не удалось создать рассылку")
+            return None
+
+        self._spawn(bot, {
+            "id": broadcast_id, "text": text, "chat_id": chat_id,
+            "status_message_id": status.message_id,
+            "last_user_id": None, "sent": 0, "failed": 0
+        })
+        return broadcast_id
+
+    async def resume(self, bot):
+        for row in await self.db.get_running_broadcasts():
+            if row["id"] not in self._tasks:
+                logger.info("Возобновление рассылки %s после пользователя %s", row['id'], row['last_user_id'])
+                self._spawn(bot, dict(row))
+
+    def cancel(self, broadcast_id):
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        self._cancelled.add(broadcast_id)
+        task.cancel()
+        return True
+
+    async def shutdown(self):
+        # Незавершенные рассылки остаются в статусе running и продолжатся после перезапуска
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, bot, record):
+        task = asyncio.create_task(self._run(bot, record))
+        self._tasks[record["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(record["id"], None))
+
+    async def _run(self, bot, record):
+        broadcast_id = record["id"]
+        progress = {"sent": record["sent"], "failed": record["failed"], "last_user_id": record["last_user_id"]}
+        started = time.monotonic()
+        done_at_start = progress["sent"] + progress["failed"]
+        last_report = started
+        status = "running"
+
+        try:
+            chunk = []
+            async for row in self.db.iter_users(after_id=progress["last_user_id"], columns=('user_id',)):
+                chunk.append(row["user_id"])
+                if len(chunk) < self.chunk_size:
+                    continue
+                await self._send_chunk(bot, broadcast_id, chunk, record["text"], progress)
+                chunk = []
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(bot, record, progress, started, done_at_start, status)
+            if chunk:
+                await self._send_chunk(bot, broadcast_id, chunk, record["text"], progress)
+            status = "done"
+        except asyncio.CancelledError:
+            status = "cancelled" if broadcast_id in self._cancelled else "running"
+            raise
+        except Exception as e:
+            logger.error("Ошибка рассылки %s: %s", broadcast_id, e)
+            status = "failed"
+        finally:
+            self._cancelled.discard(broadcast_id)
+            await self.db.save_broadcast_progress(
+                broadcast_id, progress["last_user_id"], progress["sent"], progress["failed"], status
+            )
+            if status != "running":
+                await self._report(bot, record, progress, started, done_at_start, status)
+            logger.info(
+                "Рассылка %s: статус %s, отправлено %s, ошибок %s, %.1f с",
+                broadcast_id, status, progress['sent'], progress['failed'], time.monotonic() - started
+            )
+
+    async def _send_chunk(self, bot, broadcast_id, chunk, text, progress):
+        results = await asyncio.gather(*(self._send(bot, user_id, text) for user_id in chunk))
+        delivered = sum(results)
+        progress["sent"] += delivered
+        progress["failed"] += len(results) - delivered
+        progress["last_user_id"] = chunk[-1]
+        # Контрольная точка после каждой пачки: при перезапуске повторится не больше одной пачки
+        await self.db.save_broadcast_progress(
+            broadcast_id, progress["last_user_id"], progress["sent"], progress["failed"]
+        )
+
+    async def _send(self, bot, chat_id, text):
+        for attempt in range(self.max_retries):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, text)
+                return True
+            except RetryAfter as e:
+                logger.warning("Telegram просит подождать %s с", e.retry_after)
+                self.bucket.pause(e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                logger.debug("Сообщение пользователю %s не доставлено: %s", chat_id, e)
+                return False
+            except NetworkError as e:
+                logger.warning("Сетевая ошибка при отправке пользователю %s: %s", chat_id, e)
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error("Ошибка отправки пользователю %s: %s", chat_id, e)
+                return False
+        return False
+
+    async def _report(self, bot, record, progress, started, done_at_start, status):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        throughput = (progress["sent"] + progress["failed"] - done_at_start) / elapsed
+        titles = {
+            "running": "⏳ выполняется", "done": "✅ завершена",
+            "cancelled": "⛔ остановлена", "failed": "❌ прервана ошибкой"
+        }
+        text = (
+            f"📢 Рассылка #{record['id']}: {titles[status]}\n\n"
+            f"✅ Отправлено: {progress['sent']}\n"
+            f"❌ Ошибок: {progress['failed']}\n"
+            f"⚡ Скорость: {throughput:.1f} сообщ./с"
+        )
+        try:
+            await bot.edit_message_text(text, chat_id=record["chat_id"], message_id=record["status_message_id"])
+        except TelegramError as e:
+            logger.debug("Не удалось обновить статус рассылки %s: %s", record['id'], e)
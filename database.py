@@ -1,99 +1,403 @@
+import asyncio
+import functools
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+import metrics
 
 logger = logging.getLogger(__name__)
 
+# Миграции схемы: элемент с индексом i переводит БД с версии i на i + 1 (PRAGMA user_version)
+MIGRATIONS = [
+    # 1: исходная схема
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            uuid TEXT,
+            traffic_limit INTEGER,
+            traffic_used INTEGER DEFAULT 0,
+            expire_date TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TEXT
+        )
+        ''',
+    ),
+    # 2: expire_date хранится как unix-время вместо строки '%Y-%m-%d' (полночь по локальному времени)
+    (
+        '''
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            uuid TEXT,
+            traffic_limit INTEGER,
+            traffic_used INTEGER DEFAULT 0,
+            expire_date INTEGER,
+            is_active INTEGER DEFAULT 1,
+            created_at TEXT
+        )
+        ''',
+        '''
+        INSERT INTO users_new
+        SELECT user_id, username, uuid, traffic_limit, traffic_used,
+               CAST(strftime('%s', expire_date, 'utc') AS INTEGER), is_active, created_at
+        FROM users
+        ''',
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+    ),
+    # 3: индексы для поиска по uuid, сроку действия и активности
+    (
+        "CREATE INDEX IF NOT EXISTS idx_users_uuid ON users (uuid)",
+        "CREATE INDEX IF NOT EXISTS idx_users_active_expire ON users (is_active, expire_date)",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_users_active_quota
+        ON users (traffic_limit - traffic_used) WHERE is_active = 1
+        ''',
+    ),
+    # 4: рассылки с контрольной точкой по последнему обработанному user_id
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            chat_id INTEGER,
+            status_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)",
+    ),
+    # 5: узел X-UI, на котором размещен пользователь (NULL — узел по умолчанию)
+    (
+        "ALTER TABLE users ADD COLUMN node TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_users_node ON users (node)",
+    ),
+    # 6: незавершенные регистрации — по ним откатываются ресурсы панели после сбоя
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS pending_signups (
+            user_id INTEGER PRIMARY KEY,
+            uuid TEXT NOT NULL,
+            node TEXT,
+            created_at INTEGER
+        )
+        ''',
+    ),
+    # 7: история трафика — сырые приращения и часовые/суточные агрегаты (см. traffic_history.py)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_raw (
+            user_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ts)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_traffic_raw_ts ON traffic_raw (ts, bytes)",
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_hourly (
+            user_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_traffic_hourly_bucket ON traffic_hourly (bucket, bytes)",
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_daily (
+            user_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_traffic_daily_bucket ON traffic_daily (bucket, bytes)",
+    ),
+    # 8: очередь изменений для панели — одна запись на клиента, новая операция заменяет прежнюю (см. outbox.py)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS panel_outbox (
+            node TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            op TEXT NOT NULL,
+            traffic_gb INTEGER,
+            expiry_time INTEGER,
+            created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (node, uuid)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_panel_outbox_next ON panel_outbox (next_attempt)",
+    ),
+]
+
+# Повторная постановка заменяет операцию и сбрасывает backoff, но сохраняет created_at — возраст
+# расхождения с панелью. Удаление не отменяется последующим обновлением: клиента уже нет.
+# version защищает от удаления из очереди операции, заменённой, пока шёл запрос к панели.
+OUTBOX_CONFLICT = (
+    "ON CONFLICT (node, uuid) DO UPDATE SET "
+    "op = CASE WHEN op = 'delete' THEN op ELSE excluded.op END, "
+    "traffic_gb = excluded.traffic_gb, expiry_time = excluded.expiry_time, "
+    "attempts = 0, next_attempt = excluded.next_attempt, version = version + 1"
+)
+# Задание из текущей строки users: включённый клиент получает актуальные лимиты, выключенный — отключается
+OUTBOX_SYNC = (
+    "INSERT INTO panel_outbox (node, uuid, op, traffic_gb, expiry_time, created_at, next_attempt) "
+    "SELECT COALESCE(node, ''), uuid, CASE WHEN is_active THEN 'update' ELSE 'disable' END, "
+    "traffic_limit / 1073741824, expire_date, ?, ? FROM users WHERE {} = ? AND uuid IS NOT NULL " + OUTBOX_CONFLICT
+)
+OUTBOX_INSERT = (
+    "INSERT INTO panel_outbox (node, uuid, op, traffic_gb, expiry_time, created_at, next_attempt) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?) " + OUTBOX_CONFLICT
+)
+
+USER_COLUMNS = (
+    'user_id', 'username', 'uuid', 'traffic_limit', 'traffic_used',
+    'expire_date', 'is_active', 'created_at', 'node'
+)
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
 
 class Database:
     def __init__(self, db_name='vpn_bot.db'):
+        self.db_name = db_name
+        # Своё соединение на каждый поток: sqlite3.Connection нельзя делить между потоками
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
         try:
-            self.conn = sqlite3.connect(db_name)
-            self.cursor = self.conn.cursor()
-            self._create_tables()
-            logger.info(f"База данных {db_name} успешно подключена")
+            self._migrate()
+            logger.info("База данных %s успешно подключена", db_name)
         except sqlite3.Error as e:
-            logger.critical(f"Ошибка подключения к базе данных: {str(e)}")
+            logger.critical("Ошибка подключения к базе данных: %s", e)
             raise
 
-    def _create_tables(self):
-        try:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    uuid TEXT,
-                    traffic_limit INTEGER,
-                    traffic_used INTEGER DEFAULT 0,
-                    expire_date TEXT,
-                    is_active INTEGER DEFAULT 1,
-                    created_at TEXT
-                )
-            ''')
-            self.conn.commit()
-            logger.debug("Таблицы успешно созданы/проверены")
-        except sqlite3.Error as e:
-            logger.error(f"Ошибка создания таблиц: {str(e)}")
-            raise
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False нужен только для close() из другого потока
+            conn = sqlite3.connect(self.db_name, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+            logger.debug("Открыто соединение с БД для потока %s", threading.current_thread().name)
+        return conn
+
+    def _migrate(self):
+        conn = self.conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                # DDL в sqlite3 не открывает транзакцию сам — делаем это явно
+                conn.execute("BEGIN")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.execute("COMMIT")
+                logger.info("Схема БД обновлена до версии %s", target)
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK")
+                logger.error("Ошибка миграции БД до версии %s: %s", target, e)
+                raise
+        logger.debug("Версия схемы БД: %s", max(version, len(MIGRATIONS)))
 
     def user_exists(self, user_id):
         try:
-            self.cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-            exists = self.cursor.fetchone() is not None
-            logger.debug(f"Проверка существования пользователя {user_id}: {exists}")
+            row = self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            exists = row is not None
+            logger.debug("Проверка существования пользователя %s: %s", user_id, exists)
             return exists
         except sqlite3.Error as e:
-            logger.error(f"Ошибка проверки пользователя {user_id}: {str(e)}")
+            logger.error("Ошибка проверки пользователя %s: %s", user_id, e)
             return False
 
-    def create_user(self, user_id, username, uuid, traffic_limit, expire_date):
+    def create_user(self, user_id, username, uuid, traffic_limit, expire_date, node=None):
         try:
             created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.cursor.execute('''
-                INSERT INTO users (user_id, username, uuid, traffic_limit, expire_date, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, uuid, traffic_limit, expire_date, created_at))
-            self.conn.commit()
-            logger.info(f"Создан новый пользователь: {user_id}, UUID: {uuid}")
+            with self.conn as conn:
+                conn.execute('''
+                    INSERT INTO users (user_id, username, uuid, traffic_limit, expire_date, created_at, node)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, username, uuid, traffic_limit, expire_date, created_at, node))
+            logger.info("Создан новый пользователь: %s, UUID: %s", user_id, uuid)
             return True
         except sqlite3.Error as e:
-            logger.error(f"Ошибка создания пользователя {user_id}: {str(e)}")
+            logger.error("Ошибка создания пользователя %s: %s", user_id, e)
             return False
 
     def get_user(self, user_id):
         try:
-            self.cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            row = self.cursor.fetchone()
+            row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
             if row:
-                user_data = {
-                    'user_id': row[0],
-                    'username': row[1],
-                    'uuid': row[2],
-                    'traffic_limit': row[3],
-                    'traffic_used': row[4],
-                    'expire_date': row[5],
-                    'is_active': bool(row[6]),
-                    'created_at': row[7]
-                }
-                logger.debug(f"Данные пользователя {user_id} получены")
-                return user_data
-            logger.warning(f"Пользователь {user_id} не найден")
+                logger.debug("Данные пользователя %s получены", user_id)
+                return row
+            logger.warning("Пользователь %s не найден", user_id)
             return None
         except sqlite3.Error as e:
-            logger.error(f"Ошибка получения данных пользователя {user_id}: {str(e)}")
+            logger.error("Ошибка получения данных пользователя %s: %s", user_id, e)
             return None
 
+    def get_user_by_uuid(self, uuid):
+        try:
+            return self.conn.execute("SELECT * FROM users WHERE uuid = ?", (uuid,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error("Ошибка поиска пользователя по UUID %s: %s", uuid, e)
+            return None
+
+    def get_users_page(self, after_id=None, limit=1000, columns=None, active_only=False, expiring_before=None):
+        columns = tuple(columns or USER_COLUMNS)
+        unknown = set(columns) - set(USER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Неизвестные столбцы: {', '.join(sorted(unknown))}")
+        if 'user_id' not in columns:
+            columns = ('user_id',) + columns
+
+        # Keyset-пагинация по первичному ключу: каждая страница — поиск по индексу, без OFFSET
+        conditions = []
+        params = []
+        if after_id is not None:
+            conditions.append("user_id > ?")
+            params.append(after_id)
+        if active_only:
+            conditions.append("is_active = 1")
+        if expiring_before is not None:
+            conditions.append("expire_date < ?")
+            params.append(expiring_before)
+        params.append(limit)
+
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        query = f"SELECT {', '.join(columns)} FROM users {where}ORDER BY user_id LIMIT ?"
+        try:
+            return self.conn.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения страницы пользователей после %s: %s", after_id, e)
+            return []
+
+    def iter_users(self, chunk_size=1000, after_id=None, **filters):
+        while True:
+            page = self.get_users_page(after_id, chunk_size, **filters)
+            yield from page
+            if len(page) < chunk_size:
+                return
+            after_id = page[-1]['user_id']
+
     def get_all_users(self):
+        users = [dict(row) for row in self.iter_users()]
+        logger.debug("Получено %s пользователей", len(users))
+        return users
+
+    def update_traffic_bulk(self, rows):
         try:
-            self.cursor.execute("SELECT * FROM users")
-            columns = [col[0] for col in self.cursor.description]
-            users = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-            logger.debug(f"Получено {len(users)} пользователей")
-            return users
+            # rows: [(traffic_used, user_id), ...] — одна транзакция на весь пакет
+            with self.conn as conn:
+                conn.executemany("UPDATE users SET traffic_used = ? WHERE user_id = ?", rows)
+            logger.debug("Обновлен трафик %s пользователей", len(rows))
+            return True
         except sqlite3.Error as e:
-            logger.error(f"Ошибка получения списка пользователей: {str(e)}")
+            logger.error("Ошибка пакетного обновления трафика: %s", e)
+            return False
+
+    def get_users_to_disable(self, now, limit=500):
+        try:
+            return self.conn.execute('''
+                SELECT user_id, uuid, node FROM users
+                WHERE is_active = 1 AND expire_date < ?
+                UNION
+                SELECT user_id, uuid, node FROM users
+                WHERE is_active = 1 AND traffic_limit - traffic_used <= 0
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка поиска пользователей для отключения: %s", e)
             return []
 
+    def deactivate_users(self, user_ids, now):
+        # Условие отключения проверяется заново: пока панель отключала клиента, пользователь мог продлиться
+        try:
+            deactivated = []
+            with self.conn as conn:
+                for user_id in user_ids:
+                    cursor = conn.execute(
+                        "UPDATE users SET is_active = 0 WHERE user_id = ? AND is_active = 1 "
+                        "AND (expire_date < ? OR traffic_limit - traffic_used <= 0)",
+                        (user_id, now)
+                    )
+                    if cursor.rowcount:
+                        deactivated.append(user_id)
+                # Продлившимся клиент в панели уже отключён — ставим в очередь включение с текущими лимитами
+                renewed = set(user_ids) - set(deactivated)
+                conn.executemany(OUTBOX_SYNC.format("user_id"), [(now, now, user_id) for user_id in renewed])
+            logger.info("Деактивировано пользователей: %s, продлились во время проверки: %s", len(deactivated), len(renewed))
+            return deactivated
+        except sqlite3.Error as e:
+            logger.error("Ошибка пакетной деактивации пользователей: %s", e)
+            return None
+
+    def extend_active_users(self, seconds):
+        try:
+            # Одно выражение UPDATE для всех: срок сдвигается относительно сохранённого,
+            # задания для панели ставятся в очередь той же транзакцией
+            now = int(time.time())
+            with self.conn as conn:
+                cursor = conn.execute(
+                    "UPDATE users SET expire_date = expire_date + ? WHERE is_active = 1",
+                    (seconds,)
+                )
+                conn.execute(
+                    "INSERT INTO panel_outbox (node, uuid, op, traffic_gb, expiry_time, created_at, next_attempt) "
+                    "SELECT COALESCE(node, ''), uuid, 'update', traffic_limit / 1073741824, expire_date, ?, ? "
+                    "FROM users WHERE is_active = 1 AND uuid IS NOT NULL " + OUTBOX_CONFLICT,
+                    (now, now)
+                )
+            logger.info("Продлено активных пользователей: %s", cursor.rowcount)
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error("Ошибка массового продления: %s", e)
+            return None
+
+    def renew_user(self, user_id, traffic_limit, expire_date, node, uuid):
+        # Продление и задание для панели — в одной транзакции: после сбоя панель догонит БД
+        try:
+            now = int(time.time())
+            with self.conn as conn:
+                cursor = conn.execute(
+                    "UPDATE users SET traffic_limit = ?, expire_date = ?, is_active = 1 WHERE user_id = ?",
+                    (traffic_limit, expire_date, user_id)
+                )
+                if cursor.rowcount == 0:
+                    logger.warning("Пользователь %s не найден для продления", user_id)
+                    return False
+                conn.execute(OUTBOX_INSERT, (node or '', uuid, 'update', traffic_limit // 1024 ** 3, expire_date, now, now))
+            logger.debug("Пользователь %s продлен до %s", user_id, expire_date)
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка продления пользователя %s: %s", user_id, e)
+            return False
+
     def update_user(self, user_id, **kwargs):
         try:
             if not kwargs:
@@ -105,36 +409,316 @@ class Database:
             values.append(user_id)
 
             query = f"UPDATE users SET {set_clause} WHERE user_id = ?"
-            self.cursor.execute(query, values)
-            self.conn.commit()
+            with self.conn as conn:
+                cursor = conn.execute(query, values)
 
-            success = self.cursor.rowcount > 0
+            success = cursor.rowcount > 0
             if success:
-                logger.info(f"Пользователь {user_id} обновлен: {kwargs}")
+                logger.debug("Пользователь %s обновлен: %s", user_id, kwargs)
             else:
-                logger.warning(f"Пользователь {user_id} не найден для обновления")
+                logger.warning("Пользователь %s не найден для обновления", user_id)
             return success
         except sqlite3.Error as e:
-            logger.error(f"Ошибка обновления пользователя {user_id}: {str(e)}")
+            logger.error("Ошибка обновления пользователя %s: %s", user_id, e)
             return False
 
     def delete_user(self, user_id):
         try:
-            self.cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-            self.conn.commit()
-            success = self.cursor.rowcount > 0
+            with self.conn as conn:
+                cursor = conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            success = cursor.rowcount > 0
             if success:
-                logger.info(f"Пользователь {user_id} удален из БД")
+                logger.info("Пользователь %s удален из БД", user_id)
             else:
-                logger.warning(f"Пользователь {user_id} не найден в БД")
+                logger.warning("Пользователь %s не найден в БД", user_id)
             return success
         except sqlite3.Error as e:
-            logger.error(f"Ошибка удаления пользователя {user_id}: {str(e)}")
+            logger.error("Ошибка удаления пользователя %s: %s", user_id, e)
             return False
 
+    def create_broadcast(self, text, created_by, chat_id, status_message_id):
+        try:
+            now = int(time.time())
+            with self.conn as conn:
+                cursor = conn.execute('''
+                    INSERT INTO broadcasts (text, created_by, chat_id, status_message_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (text, created_by, chat_id, status_message_id, now, now))
+            logger.info("Создана рассылка %s от %s", cursor.lastrowid, created_by)
+            return cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error("Ошибка создания рассылки: %s", e)
+            return None
+
+    def get_running_broadcasts(self):
+        try:
+            return self.conn.execute("SELECT * FROM broadcasts WHERE status = 'running'").fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения незавершенных рассылок: %s", e)
+            return []
+
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, status='running'):
+        try:
+            with self.conn as conn:
+                conn.execute('''
+                    UPDATE broadcasts
+                    SET last_user_id = ?, sent = ?, failed = ?, status = ?, updated_at = ?
+                    WHERE id = ?
+                ''', (last_user_id, sent, failed, status, int(time.time()), broadcast_id))
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка сохранения прогресса рассылки %s: %s", broadcast_id, e)
+            return False
+
+    def add_pending_signup(self, user_id, uuid):
+        try:
+            with self.conn as conn:
+                conn.execute(
+                    "INSERT INTO pending_signups (user_id, uuid, created_at) VALUES (?, ?, ?)",
+                    (user_id, uuid, int(time.time()))
+                )
+            return True
+        except sqlite3.IntegrityError:
+            logger.warning("Регистрация пользователя %s уже выполняется", user_id)
+            return False
+        except sqlite3.Error as e:
+            logger.error("Ошибка записи регистрации пользователя %s: %s", user_id, e)
+            return False
+
+    def set_pending_signup_node(self, user_id, node):
+        try:
+            with self.conn as conn:
+                conn.execute("UPDATE pending_signups SET node = ? WHERE user_id = ?", (node, user_id))
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка обновления регистрации пользователя %s: %s", user_id, e)
+            return False
+
+    def delete_pending_signup(self, user_id):
+        try:
+            with self.conn as conn:
+                conn.execute("DELETE FROM pending_signups WHERE user_id = ?", (user_id,))
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка удаления регистрации пользователя %s: %s", user_id, e)
+            return False
+
+    def get_pending_signups(self):
+        try:
+            return self.conn.execute("SELECT * FROM pending_signups").fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения незавершенных регистраций: %s", e)
+            return []
+
+    def enqueue_panel_ops(self, ops):
+        # ops: [(node, uuid, op, traffic_gb, expiry_time), ...]
+        try:
+            now = int(time.time())
+            with self.conn as conn:
+                conn.executemany(OUTBOX_INSERT, [(node or '', *rest, now, now) for node, *rest in ops])
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка постановки изменений для панели в очередь: %s", e)
+            return False
+
+    def enqueue_user_syncs(self, uuids):
+        # Узел, операция и значения берутся из users в той же транзакции — ключ тот же, что у renew_user
+        try:
+            now = int(time.time())
+            with self.conn as conn:
+                conn.executemany(OUTBOX_SYNC.format("uuid"), [(now, now, uuid) for uuid in uuids])
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка постановки сверки в очередь панели: %s", e)
+            return False
+
+    def set_user_nodes(self, rows):
+        # rows: [(node, user_id), ...]
+        try:
+            with self.conn as conn:
+                conn.executemany("UPDATE users SET node = ? WHERE user_id = ?", rows)
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка обновления узлов пользователей: %s", e)
+            return False
+
+    def get_pending_panel_uuids(self):
+        try:
+            rows = self.conn.execute("SELECT uuid FROM panel_outbox UNION SELECT uuid FROM pending_signups").fetchall()
+            return {uuid for uuid, in rows}
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения клиентов в очереди панели: %s", e)
+            return set()
+
+    def get_due_panel_ops(self, now, limit=1000):
+        try:
+            return self.conn.execute(
+                "SELECT node, uuid, op, traffic_gb, expiry_time, attempts, version FROM panel_outbox "
+                "WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (now, limit)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка чтения очереди изменений для панели: %s", e)
+            return []
+
+    def complete_panel_ops(self, done):
+        # done: [(node, uuid, version), ...]; заменённые за время запроса операции остаются в очереди
+        try:
+            with self.conn as conn:
+                conn.executemany("DELETE FROM panel_outbox WHERE node = ? AND uuid = ? AND version = ?", done)
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка удаления выполненных изменений для панели: %s", e)
+            return False
+
+    def retry_panel_ops(self, failed):
+        # failed: [(next_attempt, node, uuid, version), ...]
+        try:
+            with self.conn as conn:
+                conn.executemany(
+                    "UPDATE panel_outbox SET attempts = attempts + 1, next_attempt = ? "
+                    "WHERE node = ? AND uuid = ? AND version = ?",
+                    failed
+                )
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка переноса изменений для панели: %s", e)
+            return False
+
+    def get_panel_outbox_stats(self):
+        try:
+            return tuple(self.conn.execute("SELECT COUNT(*), MIN(created_at) FROM panel_outbox").fetchone())
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения состояния очереди изменений для панели: %s", e)
+            return None
+
     def close(self):
         try:
-            self.conn.close()
+            with self._connections_lock:
+                for conn in self._connections:
+                    # Обновляет статистику планировщика, чтобы частичные индексы выбирались корректно
+                    conn.execute("PRAGMA optimize")
+                    conn.close()
+                self._connections.clear()
+            self._local = threading.local()
             logger.info("Соединение с базой данных закрыто")
         except sqlite3.Error as e:
-            logger.error(f"Ошибка при закрытии соединения: {str(e)}")
\ No newline at end of file
+            logger.error("Ошибка при закрытии соединения: %s", e)
+
+
+class AsyncDatabase:
+    # Выполняет методы Database в пуле потоков, чтобы обработчики не ждали диск в event loop
+    def __init__(self, db, max_workers=4, cache=None):
+        self.db = db
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sqlite")
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._timed, func, args, kwargs))
+
+    @staticmethod
+    def _timed(func, args, kwargs):
+        # Замер в потоке пула: время самого запроса, без ожидания свободного потока
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.DB_LATENCY.observe(time.perf_counter() - started, query=func.__name__)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        async def wrapper(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        wrapper.__name__ = name
+        setattr(self, name, wrapper)
+        return wrapper
+
+    async def get_user(self, user_id):
+        if self.cache is not None:
+            user = self.cache.get(user_id)
+            if user is not None:
+                return user
+        user = await self.run(self.db.get_user, user_id)
+        if user is not None and self.cache is not None:
+            self.cache.put(user_id, user)
+        return user
+
+    async def user_exists(self, user_id):
+        if self.cache is None:
+            return await self.run(self.db.user_exists, user_id)
+        return await self.get_user(user_id) is not None
+
+    async def create_user(self, user_id, username, uuid, traffic_limit, expire_date, node=None):
+        def create_user():
+            if not self.db.create_user(user_id, username, uuid, traffic_limit, expire_date, node):
+                return False, None
+            return True, (self.db.get_user(user_id) if self.cache is not None else None)
+
+        created, user = await self.run(create_user)
+        if user is not None:
+            self.cache.put(user_id, user)
+        return created
+
+    async def update_user(self, user_id, **kwargs):
+        success = await self.run(self.db.update_user, user_id, **kwargs)
+        if success and self.cache is not None:
+            self.cache.update(user_id, **kwargs)
+        return success
+
+    async def renew_user(self, user_id, traffic_limit, expire_date, node, uuid):
+        success = await self.run(self.db.renew_user, user_id, traffic_limit, expire_date, node, uuid)
+        if success and self.cache is not None:
+            self.cache.update(user_id, traffic_limit=traffic_limit, expire_date=expire_date, is_active=1)
+        return success
+
+    async def delete_user(self, user_id):
+        success = await self.run(self.db.delete_user, user_id)
+        if self.cache is not None:
+            self.cache.invalidate(user_id)
+        return success
+
+    async def update_traffic_bulk(self, rows):
+        success = await self.run(self.db.update_traffic_bulk, rows)
+        if success and self.cache is not None:
+            for traffic_used, user_id in rows:
+                self.cache.update(user_id, traffic_used=traffic_used)
+        return success
+
+    async def deactivate_users(self, user_ids, now):
+        deactivated = await self.run(self.db.deactivate_users, user_ids, now)
+        if deactivated and self.cache is not None:
+            for user_id in deactivated:
+                self.cache.update(user_id, is_active=0)
+        return deactivated
+
+    async def set_user_nodes(self, rows):
+        success = await self.run(self.db.set_user_nodes, rows)
+        if success and self.cache is not None:
+            for node, user_id in rows:
+                self.cache.update(user_id, node=node)
+        return success
+
+    async def extend_active_users(self, seconds):
+        count = await self.run(self.db.extend_active_users, seconds)
+        if count and self.cache is not None:
+            self.cache.clear()
+        return count
+
+    async def iter_users(self, chunk_size=1000, after_id=None, **filters):
+        # Каждая страница читается в пуле потоков; в памяти держится не больше chunk_size строк
+        while True:
+            page = await self.run(self.db.get_users_page, after_id, chunk_size, **filters)
+            for row in page:
+                yield row
+            if len(page) < chunk_size:
+                return
+            after_id = page[-1]['user_id']
+
+    async def close(self):
+        await self.run(self.db.close)
+        self._executor.shutdown(wait=True)
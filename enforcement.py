@@ -0,0 +1,55 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EnforcementSweep:
+    def __init__(self, db, pool, outbox, batch_size=500, concurrency=5):
+        self.db = db
+        self.pool = pool
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    async def run(self, context=None):
+        started = time.monotonic()
+        now = int(time.time())
+        total = 0
+
+        while True:
+            rows = await self.db.get_users_to_disable(now, self.batch_size)
+            if not rows:
+                break
+
+            disabled = await self._disable(rows)
+            user_ids = [user_id for user_id, uuid, _ in rows if uuid in disabled]
+            if user_ids:
+                deactivated = await self.db.deactivate_users(user_ids, now)
+                if deactivated is None:
+                    break
+                # Продлившиеся за время запроса к панели получили задание на повторное включение
+                if len(deactivated) < len(user_ids):
+                    self.outbox.notify()
+                total += len(deactivated)
+
+            # Неудачные отключения повторим на следующем проходе, а не в этом цикле
+            if len(user_ids) < len(rows):
+                logger.warning("Не удалось отключить в панели: %s пользователей", len(rows) - len(user_ids))
+                break
+
+        if total:
+            logger.info("Проверка подписок: отключено %s пользователей за %.3f с", total, time.monotonic() - started)
+
+    async def _disable(self, rows):
+        by_node = {}
+        for _, uuid, node_name in rows:
+            by_node.setdefault(node_name, []).append(uuid)
+
+        disabled = set()
+        for node_name, uuids in by_node.items():
+            node = self.pool.get(node_name)
+            if node is None or not node.healthy:
+                continue
+            disabled |= await node.api.disable_clients(uuids, self.concurrency)
+        return disabled
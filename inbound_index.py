@@ -0,0 +1,107 @@
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class InboundIndex:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._loaded_at = None
+        self.generation = 0
+        self._inbounds = {}
+        self._by_uuid = {}
+        self._by_email = {}
+        self._by_port = {}
+
+    def is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def invalidate(self):
+        self._loaded_at = None
+        logger.debug("Индекс inbounds помечен как устаревший")
+
+    def load(self, inbounds):
+        self._inbounds.clear()
+        self._by_uuid.clear()
+        self._by_email.clear()
+        self._by_port.clear()
+        for inbound in inbounds:
+            self._add(inbound)
+        self._loaded_at = time.monotonic()
+        self.generation += 1
+        logger.debug("Индекс inbounds перестроен: %s inbounds, %s клиентов", len(self._inbounds), len(self._by_uuid))
+
+    def put(self, inbound):
+        if inbound.get("id") in self._inbounds:
+            self._drop(inbound["id"])
+        self._add(inbound)
+
+    def remove(self, inbound_id):
+        if inbound_id in self._inbounds:
+            self._drop(inbound_id)
+
+    def list(self):
+        return list(self._inbounds.values())
+
+    def client_count(self):
+        return len(self._by_uuid)
+
+    def total_traffic(self):
+        return sum(inbound.get("up", 0) + inbound.get("down", 0) for inbound in self._inbounds.values())
+
+    def used_ports(self):
+        return set(self._by_port)
+
+    def get(self, inbound_id):
+        return self._inbounds.get(inbound_id)
+
+    def get_by_uuid(self, uuid):
+        return self._lookup(self._by_uuid.get(uuid), "id", uuid)
+
+    def get_by_email(self, email):
+        return self._lookup(self._by_email.get(email), "email", email)
+
+    def get_by_port(self, port):
+        inbound_id = self._by_port.get(port)
+        return self._inbounds.get(inbound_id) if inbound_id is not None else None
+
+    def _lookup(self, inbound_id, key, value):
+        if inbound_id is None:
+            return None
+        inbound = self._inbounds[inbound_id]
+        for client in inbound["settings"].get("clients", []):
+            if client.get(key) == value:
+                return inbound, client
+        return None
+
+    def _add(self, inbound):
+        # settings из панели приходят строкой — разбираем один раз при загрузке
+        if isinstance(inbound.get("settings"), str):
+            try:
+                inbound["settings"] = json.loads(inbound["settings"])
+            except json.JSONDecodeError:
+                logger.error("Не удалось декодировать настройки inbound %s", inbound.get('id'))
+                inbound["settings"] = {}
+        inbound.setdefault("settings", {})
+
+        inbound_id = inbound.get("id")
+        self._inbounds[inbound_id] = inbound
+        if inbound.get("port") is not None:
+            self._by_port[inbound["port"]] = inbound_id
+        for client in inbound["settings"].get("clients", []):
+            if client.get("id"):
+                self._by_uuid[client["id"]] = inbound_id
+            if client.get("email"):
+                self._by_email[client["email"]] = inbound_id
+
+    def _drop(self, inbound_id):
+        inbound = self._inbounds.pop(inbound_id)
+        if self._by_port.get(inbound.get("port")) == inbound_id:
+            del self._by_port[inbound["port"]]
+        for client in inbound["settings"].get("clients", []):
+            if self._by_uuid.get(client.get("id")) == inbound_id:
+                del self._by_uuid[client["id"]]
+            if self._by_email.get(client.get("email")) == inbound_id:
+                del self._by_email[client["email"]]
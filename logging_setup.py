@@ -0,0 +1,95 @@
+import json
+import queue
+import atexit
+import logging
+import itertools
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        # {"httpx": 100}: из логгера httpx и его потомков проходит каждая сотая запись ниже WARNING
+        self.rates = rates
+        self._resolved = {}
+        self._counters = {}
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1
+            for prefix, value in self.rates.items():
+                if name == prefix or name.startswith(prefix + "."):
+                    rate = value
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate <= 1:
+            return True
+        counter = self._counters.get(record.name)
+        if counter is None:
+            counter = self._counters.setdefault(record.name, itertools.count())
+        return next(counter) % rate == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Переполненная очередь не должна останавливать обработчики: лишние записи отбрасываются
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(config):
+    level = getattr(logging, str(config.get('LOG_LEVEL', 'INFO')).upper(), logging.INFO)
+
+    file_handler = RotatingFileHandler(
+        config.get('LOG_FILE', 'vpn_bot.log'),
+        maxBytes=config.get('LOG_MAX_BYTES', 10 * 1024 * 1024),
+        backupCount=config.get('LOG_BACKUP_COUNT', 5),
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    # Запись на диск и в консоль идёт в отдельном потоке QueueListener
+    handler = DroppingQueueHandler(queue.Queue(maxsize=config.get('LOG_QUEUE_SIZE', 10000)))
+    handler.addFilter(SamplingFilter(config.get('LOG_SAMPLING', {'httpx': 100})))
+    listener = QueueListener(handler.queue, file_handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,268 @@
+import re
+import time
+import asyncio
+import logging
+import functools
+import threading
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_ID_SEGMENT = re.compile(r"/(\d+|[0-9a-fA-F-]{36})(?=/|$)")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self._values[tuple(labels.get(n, "") for n in self.labelnames)] = value
+
+    def set_function(self, func, **labels):
+        # Значение считается только в момент опроса /metrics
+        self._functions[tuple(labels.get(n, "") for n in self.labelnames)] = func
+
+    def collect(self):
+        values = dict(self._values)
+        for key, func in self._functions.items():
+            try:
+                values[key] = func()
+            except Exception as e:
+                logger.error("Ошибка вычисления метрики %s: %s", self.name, e)
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [счётчики по корзинам (не накопительные), сумма, количество]
+        self._series = {}
+        # observe вызывается и из потоков пула SQLite
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, (("le", _format_value(bound)),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "vpn_bot_handler_seconds", "Время обработки обновления Telegram", ("handler",)
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "vpn_bot_handler_errors_total", "Исключения в обработчиках Telegram", ("handler",)
+))
+XUI_LATENCY = REGISTRY.register(Histogram(
+    "vpn_bot_xui_request_seconds", "Время запроса к панели X-UI", ("endpoint", "status")
+))
+DB_LATENCY = REGISTRY.register(Histogram(
+    "vpn_bot_db_query_seconds", "Время выполнения запроса к SQLite в потоке пула", ("query",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "vpn_bot_event_loop_lag_seconds", "Задержка цикла событий asyncio",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+))
+CACHE_HITS = REGISTRY.register(Gauge("vpn_bot_user_cache_hits", "Попадания в кэш пользователей"))
+CACHE_MISSES = REGISTRY.register(Gauge("vpn_bot_user_cache_misses", "Промахи кэша пользователей"))
+CACHE_HIT_RATE = REGISTRY.register(Gauge("vpn_bot_user_cache_hit_ratio", "Доля попаданий в кэш пользователей"))
+CACHE_SIZE = REGISTRY.register(Gauge("vpn_bot_user_cache_entries", "Записей в кэше пользователей"))
+NODE_HEALTHY = REGISTRY.register(Gauge("vpn_bot_node_healthy", "Доступность узла X-UI", ("node",)))
+UPDATE_QUEUE_DEPTH = REGISTRY.register(Gauge("vpn_bot_update_queue_depth", "Обновления Telegram, ожидающие обработки"))
+WEBHOOK_REJECTED = REGISTRY.register(Counter(
+    "vpn_bot_webhook_rejected_total", "Обновления, отклонённые webhook с 503 из-за переполненной очереди"
+))
+RATE_LIMITED = REGISTRY.register(Counter(
+    "vpn_bot_rate_limited_total", "Callback-запросы, отклонённые ограничителем", ("scope",)
+))
+LOG_DROPPED = REGISTRY.register(Gauge("vpn_bot_log_dropped", "Записи журнала, отброшенные при переполнении очереди"))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "vpn_bot_startup_seconds", "Время от запуска процесса до завершения этапа прогрева", ("phase",)
+))
+READY = REGISTRY.register(Gauge("vpn_bot_ready", "Прогрев завершён: панель доступна, кэши заполнены"))
+OUTBOX_DEPTH = REGISTRY.register(Gauge("vpn_bot_outbox_depth", "Изменения, ожидающие применения в панели"))
+OUTBOX_AGE = REGISTRY.register(Gauge(
+    "vpn_bot_outbox_oldest_seconds", "Возраст самого старого неприменённого изменения для панели"
+))
+OUTBOX_PROCESSED = REGISTRY.register(Counter(
+    "vpn_bot_outbox_processed_total", "Попытки применить изменения из очереди панели", ("op", "result")
+))
+
+
+def endpoint_label(endpoint):
+    # Идентификаторы inbound и UUID клиентов в пути заменяются, чтобы число серий было ограничено
+    return _ID_SEGMENT.sub("/{id}", endpoint)
+
+
+def instrument(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler.__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=handler.__name__)
+    return wrapper
+
+
+def watch_cache(cache):
+    CACHE_HITS.set_function(lambda: cache.hits)
+    CACHE_MISSES.set_function(lambda: cache.misses)
+    CACHE_HIT_RATE.set_function(cache.hit_rate)
+    CACHE_SIZE.set_function(lambda: len(cache))
+
+
+def watch_nodes(pool):
+    for node in pool.nodes.values():
+        NODE_HEALTHY.set_function(lambda node=node: int(node.healthy), node=node.name)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - started - self.interval))
+
+
+class MetricsServer:
+    def __init__(self, host="127.0.0.1", port=9100, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status, body, content_type = "404 Not Found", b"not found\n", "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error("Ошибка обработки запроса метрик: %s", e)
+        finally:
+            writer.close()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import xui_api
+
+logger = logging.getLogger(__name__)
+
+
+class Node:
+    def __init__(self, name, api):
+        self.name = name
+        self.api = api
+        self.healthy = True
+
+    def load(self, placement):
+        if placement == "traffic":
+            return self.api.index.total_traffic()
+        return self.api.index.client_count()
+
+
+class NodePool:
+    def __init__(self, nodes, placement="clients"):
+        self.nodes = {node.name: node for node in nodes}
+        # Пользователи без записанного узла (созданные до пула) живут на первом узле
+        self.default = nodes[0].name
+        self.placement = placement
+
+    @classmethod
+    def from_config(cls, config, transport=None):
+        node_configs = config.get('XUI_NODES') or [{
+            "name": "main",
+            "url": config['XUI_PANEL_URL'],
+            "username": config['XUI_USERNAME'],
+            "password": config['XUI_PASSWORD'],
+            "api_prefix": config.get('XUI_API_PREFIX', ''),
+            "host": config.get('XUI_PUBLIC_HOST', "divan4ikbmstu.online"),
+            "shared_inbounds": config.get('XUI_SHARED_INBOUNDS')
+        }]
+        nodes = []
+        for node_config in node_configs:
+            api = xui_api.AsyncXUIAPI(
+                node_config['url'],
+                node_config['username'],
+                node_config['password'],
+                node_config.get('api_prefix', ''),
+                public_host=node_config.get('host', "divan4ikbmstu.online"),
+                shared_inbounds=node_config.get('shared_inbounds'),
+                shared_capacity=node_config.get('shared_capacity', config.get('XUI_SHARED_CAPACITY', 500)),
+                cache_ttl=config.get('XUI_CACHE_TTL', 60),
+                port_range=(config.get('XUI_PORT_START', 21000), config.get('XUI_PORT_END', 30000)),
+                timeout=config.get('XUI_TIMEOUT', 15),
+                max_connections=config.get('XUI_MAX_CONNECTIONS', 20),
+                max_concurrency=config.get('XUI_MAX_CONCURRENCY', 10),
+                session_ttl=config.get('XUI_SESSION_TTL', 3600),
+                health_ttl=config.get('XUI_HEALTH_TTL', 30),
+                transport=transport
+            )
+            nodes.append(Node(node_config['name'], api))
+        logger.info("Пул X-UI: %s", ', '.join(node.name for node in nodes))
+        return cls(nodes, placement=config.get('XUI_PLACEMENT', "clients"))
+
+    def get(self, name=None):
+        node = self.nodes.get(name or self.default)
+        if node is None:
+            logger.error("Неизвестный узел X-UI: %s", name)
+        return node
+
+    def healthy_nodes(self):
+        return [node for node in self.nodes.values() if node.healthy]
+
+    async def check_health(self, context=None, force=False):
+        results = await asyncio.gather(*(node.api.is_healthy(force) for node in self.nodes.values()))
+        for node, healthy in zip(self.nodes.values(), results):
+            if healthy != node.healthy:
+                if healthy:
+                    logger.info("Узел %s возвращен в ротацию", node.name)
+                else:
+                    logger.warning("Узел %s выведен из ротации", node.name)
+            node.healthy = healthy
+        return any(results)
+
+    async def is_healthy(self):
+        # Проверка каждого узла кэшируется внутри AsyncXUIAPI, поэтому вызов дешёвый
+        return await self.check_health()
+
+    async def create_user(self, remark, traffic_gb=40, expire_days=30, client_id=None):
+        candidates = self.healthy_nodes()
+        # Прогреваем индексы, чтобы сравнивать узлы по актуальной загрузке
+        await asyncio.gather(*(node.api.get_inbounds() for node in candidates))
+        for node in sorted(candidates, key=lambda n: n.load(self.placement)):
+            result = await node.api.create_user(
+                remark, traffic_gb=traffic_gb, expire_days=expire_days, client_id=client_id
+            )
+            if result:
+                uuid, port = result
+                logger.info("Пользователь %s размещен на узле %s", uuid, node.name)
+                return node.name, uuid, port
+            logger.warning("Не удалось создать пользователя на узле %s, пробуем следующий", node.name)
+        logger.error("Ни один узел не смог создать пользователя")
+        return None
+
+    async def update_clients(self, node_name, changes):
+        node = self.get(node_name)
+        if node is None:
+            return set(), []
+        return await node.api.update_clients(changes)
+
+    async def disable_clients(self, node_name, uuids):
+        node = self.get(node_name)
+        if node is None:
+            return set()
+        return await node.api.disable_clients(uuids)
+
+    async def delete_clients(self, node_name, uuids):
+        node = self.get(node_name)
+        if node is None:
+            return set()
+        return await node.api.delete_clients(uuids)
+
+    async def delete_everywhere(self, uuid):
+        # Узел неизвестен (сбой между созданием в панели и записью в БД) — ищем клиента на всех узлах
+        deleted = False
+        for node in self.nodes.values():
+            if await node.api._find_user_inbound(uuid) is not None:
+                deleted = await node.api.delete_user(uuid) or deleted
+        return deleted
+
+    def generate_config(self, node_name, uuid, port):
+        return self.get(node_name).api.generate_config(uuid, port)
+
+    async def get_client_traffic(self):
+        results = await asyncio.gather(*(node.api.get_client_traffic() for node in self.nodes.values()))
+        if all(usage is None for usage in results):
+            return None
+        merged = {}
+        for usage in results:
+            merged.update(usage or {})
+        return merged
+
+    async def close(self):
+        await asyncio.gather(*(node.api.close() for node in self.nodes.values()))
@@ -0,0 +1,141 @@
+import time
+import random
+import asyncio
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PanelOutbox:
+    # Фоновый исполнитель таблицы panel_outbox: обработчики пишут изменение в БД вместе с заданием
+    # и сразу отвечают пользователю, а панель догоняет их пачками с повторами
+    def __init__(self, db, pool, batch_size=1000, flush_interval=0.5, poll_interval=5,
+                 backoff_base=2, backoff_max=300):
+        self.db = db
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.depth = 0
+        self.oldest = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def age(self):
+        return time.time() - self.oldest if self.oldest is not None else 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        # Незавершённые задания остаются в таблице и выполнятся после перезапуска
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self):
+        self._wake.set()
+
+    async def enqueue(self, ops):
+        if not await self.db.enqueue_panel_ops(ops):
+            return False
+        self.notify()
+        return True
+
+    async def enqueue_syncs(self, uuids):
+        if not await self.db.enqueue_user_syncs(uuids):
+            return False
+        self.notify()
+        return True
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            # Короткая пауза собирает изменения нескольких обработчиков в один запрос к панели
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error("Ошибка обработки очереди изменений для панели: %s", e)
+
+    async def drain(self):
+        started = time.monotonic()
+        applied = failed = 0
+        while True:
+            rows = await self.db.get_due_panel_ops(int(time.time()), self.batch_size)
+            if not rows:
+                break
+            done, retry = await self._apply(rows)
+            if done:
+                await self.db.complete_panel_ops(done)
+            if retry:
+                await self.db.retry_panel_ops(retry)
+            applied += len(done)
+            failed += len(retry)
+            if len(rows) < self.batch_size:
+                break
+
+        stats = await self.db.get_panel_outbox_stats()
+        if stats is not None:
+            self.depth, self.oldest = stats
+        if applied or failed:
+            logger.info(
+                "Очередь панели: применено %s, отложено %s, осталось %s, за %.3f с",
+                applied, failed, self.depth, time.monotonic() - started
+            )
+
+    async def _apply(self, rows):
+        by_node = {}
+        for row in rows:
+            by_node.setdefault(row['node'], []).append(row)
+        results = await asyncio.gather(
+            *(self._apply_node(node, node_rows) for node, node_rows in by_node.items()),
+            return_exceptions=True
+        )
+
+        done = []
+        retry = []
+        now = time.time()
+        for (node, node_rows), succeeded in zip(by_node.items(), results):
+            if isinstance(succeeded, Exception):
+                logger.error("Ошибка применения изменений на узле %s: %s", node or "по умолчанию", succeeded)
+                succeeded = set()
+            for row in node_rows:
+                key = (row['node'], row['uuid'], row['version'])
+                if row['uuid'] in succeeded:
+                    done.append(key)
+                    metrics.OUTBOX_PROCESSED.inc(op=row['op'], result="applied")
+                else:
+                    retry.append((int(now + self._backoff(row['attempts'])),) + key)
+                    metrics.OUTBOX_PROCESSED.inc(op=row['op'], result="retry")
+        return done, retry
+
+    async def _apply_node(self, node, rows):
+        # Все изменения узла — одним вызовом на вид операции: update_clients шлёт один запрос на inbound
+        changes = {row['uuid']: (row['traffic_gb'], row['expiry_time']) for row in rows if row['op'] == 'update'}
+        disables = [row['uuid'] for row in rows if row['op'] == 'disable']
+        deletes = [row['uuid'] for row in rows if row['op'] == 'delete']
+        succeeded = set()
+        if changes:
+            updated, missing = await self.pool.update_clients(node, changes)
+            # Повтор не создаст клиента, которого нет в панели, — это расхождение для сверки, а не для очереди
+            if missing:
+                logger.warning("Изменения для отсутствующих в панели клиентов сняты с очереди: %s", len(missing))
+            succeeded |= updated | set(missing)
+        if disables:
+            succeeded |= await self.pool.disable_clients(node, disables)
+        if deletes:
+            succeeded |= await self.pool.delete_clients(node, deletes)
+        return succeeded
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_base * 2 ** attempts, self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
@@ -0,0 +1,56 @@
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PortAllocator:
+    def __init__(self, start=21000, end=30000):
+        self.start = start
+        self.end = end
+        self._lock = threading.Lock()
+        # Битовая карта занятости + очередь свободных портов: резервирование за O(1)
+        self._used = bytearray(end - start)
+        self._free = deque()
+        # Выданные, но ещё не подтверждённые панелью порты переживают rebuild
+        self._pending = set()
+        self.ready = False
+
+    def rebuild(self, used_ports):
+        with self._lock:
+            self._used = bytearray(self.end - self.start)
+            for port in set(used_ports) | self._pending:
+                if isinstance(port, int) and self.start <= port < self.end:
+                    self._used[port - self.start] = 1
+            self._free = deque(
+                port for port in range(self.start, self.end)
+                if not self._used[port - self.start]
+            )
+            self.ready = True
+        logger.info("Пул портов перестроен: свободно %s из %s", len(self._free), self.end - self.start)
+
+    def reserve(self):
+        with self._lock:
+            if self._free:
+                port = self._free.popleft()
+                self._used[port - self.start] = 1
+                self._pending.add(port)
+                logger.debug("Зарезервирован порт: %s", port)
+                return port
+        logger.error("Не найдено свободных портов в указанном диапазоне")
+        raise RuntimeError("Свободный порт не найден")
+
+    def confirm(self, port):
+        with self._lock:
+            self._pending.discard(port)
+
+    def release(self, port):
+        if not (isinstance(port, int) and self.start <= port < self.end):
+            return
+        with self._lock:
+            self._pending.discard(port)
+            if self._used[port - self.start]:
+                self._used[port - self.start] = 0
+                self._free.append(port)
+                logger.debug("Порт %s возвращен в пул", port)
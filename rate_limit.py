@@ -0,0 +1,101 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+import metrics
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        # Ожидающие обслуживаются по очереди, чтобы не будить всех разом
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Telegram вернул RetryAfter: никто не отправляет, пока не истечёт пауза
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class UserRateLimiter:
+    def __init__(self, rate, capacity=None, max_users=10000):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.max_users = max_users
+        # user_id -> [токены, время пополнения]; давно неактивные вытесняются, память ограничена max_users
+        self._buckets = OrderedDict()
+
+    def allow(self, user_id, tokens=1):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.capacity, now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= tokens:
+            bucket[0] -= tokens
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class CallbackThrottle:
+    def __init__(self, users, panel):
+        self.users = users
+        self.panel = panel
+
+    def allow_panel(self):
+        # Общий бюджет запросов к панели для обработчиков, которые обращаются к ней напрямую
+        if self.panel.try_acquire():
+            return True
+        metrics.RATE_LIMITED.inc(scope="panel")
+        return False
+
+    def wrap(self, handler):
+        # Отказ — только ответ на callback: без чтения БД и запросов к панели
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            query = update.callback_query
+            if not self.users.allow(query.from_user.id):
+                metrics.RATE_LIMITED.inc(scope="user")
+                await query.answer("⏳ Слишком часто, подождите пару секунд")
+                return
+            return await handler(update, context)
+        return wrapper
@@ -0,0 +1,210 @@
+import re
+import time
+import asyncio
+import logging
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+DAY = 86400
+# Клиенты, созданные ботом (см. AsyncXUIAPI.create_user); чужие клиенты панели сверка не трогает
+BOT_EMAIL = re.compile(r"^user_\d+_[0-9a-f]{8}@vpn\.com$")
+
+
+class Reconciler:
+    # Сверка users и панели: обе стороны читаются один раз, соединяются по UUID в словарях,
+    # исправления уходят пачками через очередь панели
+    def __init__(self, db, pool, outbox, batch_size=500, batch_rate=1, max_deletes=100,
+                 expiry_tolerance=60, auto_apply=False):
+        self.db = db
+        self.pool = pool
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.batch_rate = batch_rate
+        self.max_deletes = max_deletes
+        self.expiry_tolerance = expiry_tolerance
+        self.auto_apply = auto_apply
+        self.last_report = None
+        self._lock = asyncio.Lock()
+
+    async def run(self, context=None, apply=None):
+        apply = self.auto_apply if apply is None else apply
+        async with self._lock:
+            started = time.monotonic()
+            report = await self._diff()
+            if report is None:
+                return None
+            if apply:
+                await self._apply(report)
+            report["applied"] = apply
+            report["duration"] = time.monotonic() - started
+            self.last_report = report
+            logger.info(
+                "Сверка с панелью%s: пользователей %s, клиентов %s, сирот %s, нет в панели %s, "
+                "расхождений %s, сменили узел %s, дублей %s, за %.3f с",
+                "" if apply else " (без исправлений)", report["users"], report["clients"],
+                len(report["orphans"]), len(report["missing"]), len(report["mismatched"]),
+                len(report["moved"]), len(report["duplicates"]), report["duration"]
+            )
+            return report
+
+    async def _load_panel(self):
+        nodes = list(self.pool.nodes.values())
+        await asyncio.gather(*(node.api.get_inbounds(force=True) for node in nodes))
+        clients = {}
+        skipped = []
+        for node in nodes:
+            # Без свежего списка узел не сверяется: иначе все его клиенты сочлись бы пропавшими
+            if not node.api.index.is_fresh():
+                skipped.append(node.name)
+                continue
+            for inbound in node.api.index.list():
+                for client in inbound.get("settings", {}).get("clients", []):
+                    clients.setdefault(client.get("id"), []).append((node.name, client))
+        return clients, skipped
+
+    async def _diff(self):
+        clients, skipped = await self._load_panel()
+        if len(skipped) == len(self.pool.nodes):
+            logger.warning("Сверка пропущена: ни один узел X-UI не вернул список inbounds")
+            return None
+        # Клиенты в очереди панели и незавершённые регистрации ещё сходятся — их не трогаем
+        pending = await self.db.get_pending_panel_uuids()
+
+        report = {
+            "users": 0, "clients": len(clients), "skipped_nodes": skipped, "pending": len(pending),
+            "orphans": [], "missing": [], "mismatched": [], "moved": [], "duplicates": [],
+        }
+        seen = set()
+        async for user in self.db.iter_users(
+            columns=('uuid', 'node', 'traffic_limit', 'expire_date', 'is_active')
+        ):
+            uuid = user['uuid']
+            if uuid is None:
+                continue
+            report["users"] += 1
+            seen.add(uuid)
+            if uuid in pending:
+                continue
+            node = user['node'] or self.pool.default
+            found = clients.get(uuid)
+            if found is None:
+                if user['is_active'] and node not in skipped:
+                    report["missing"].append((user['user_id'], uuid, node, user['traffic_limit'], user['expire_date']))
+                continue
+            if len(found) > 1:
+                report["duplicates"].append((user['user_id'], uuid, [name for name, _ in found]))
+                continue
+
+            panel_node, client = found[0]
+            # NULL в users.node означает узел по умолчанию — это не перемещение
+            if panel_node != node:
+                report["moved"].append((user['user_id'], uuid, node, panel_node))
+            fields = self._compare(user, client)
+            if fields:
+                report["mismatched"].append((user['user_id'], uuid, panel_node, fields, user['is_active']))
+
+        for uuid, found in clients.items():
+            if uuid in seen or uuid in pending:
+                continue
+            for node, client in found:
+                if BOT_EMAIL.match(client.get("email", "")):
+                    report["orphans"].append((node, uuid, client.get("email")))
+        return report
+
+    def _compare(self, user, client):
+        fields = []
+        if not user['is_active']:
+            if client.get("enable", True):
+                fields.append("enable")
+            return fields
+        if not client.get("enable", True):
+            fields.append("enable")
+        if client.get("totalGB") != user['traffic_limit'] // GB:
+            fields.append("totalGB")
+        if abs(client.get("expiryTime", 0) // 1000 - user['expire_date']) > self.expiry_tolerance:
+            fields.append("expiryTime")
+        return fields
+
+    async def _apply(self, report):
+        bucket = TokenBucket(self.batch_rate, capacity=1)
+
+        # Узел исправляется до постановки заданий: очередь берёт его из users
+        if report["moved"]:
+            await self.db.set_user_nodes([(new, user_id) for user_id, _, _, new in report["moved"]])
+
+        # Значения для панели берутся из users в момент постановки: продление, случившееся
+        # после чтения БД, не будет перезаписано устаревшими данными
+        syncs = [uuid for _, uuid, _, _, _ in report["mismatched"]]
+        for i in range(0, len(syncs), self.batch_size):
+            await bucket.acquire()
+            await self.outbox.enqueue_syncs(syncs[i:i + self.batch_size])
+
+        if len(report["orphans"]) > self.max_deletes:
+            # Массовые «сироты» чаще означают чужую или неполную БД, чем реальный мусор в панели
+            logger.error(
+                "Сверка: сирот %s больше порога %s, удаление пропущено",
+                len(report["orphans"]), self.max_deletes
+            )
+        else:
+            # Пользователь мог зарегистрироваться, пока шла сверка, — перепроверяем каждого
+            pending = await self.db.get_pending_panel_uuids()
+            deletes = []
+            for node, uuid, _ in report["orphans"]:
+                if uuid not in pending and await self.db.get_user_by_uuid(uuid) is None:
+                    deletes.append((node, uuid, "delete", None, None))
+            for i in range(0, len(deletes), self.batch_size):
+                await bucket.acquire()
+                await self.outbox.enqueue(deletes[i:i + self.batch_size])
+
+        if not report["missing"]:
+            return
+        # Клиент мог появиться в панели после её чтения (регистрация во время сверки)
+        clients, _ = await self._load_panel()
+        now = int(time.time())
+        for user_id, uuid, node, traffic_limit, expire_date in report["missing"]:
+            if uuid in clients:
+                continue
+            # Восстановление — отдельными запросами: пакетного API для создания клиентов нет
+            await bucket.acquire()
+            result = await self.pool.create_user(
+                remark=f"user_{user_id}",
+                traffic_gb=traffic_limit // GB,
+                expire_days=max(1, -(-(expire_date - now) // DAY)),
+                client_id=uuid
+            )
+            if not result:
+                logger.error("Сверка: не удалось восстановить клиента пользователя %s", user_id)
+                continue
+            # Узел по умолчанию оставляем как есть (в том числе NULL), чтобы ключ очереди не менялся
+            if result[0] != node:
+                await self.db.update_user(user_id, node=result[0])
+            # Точный срок из БД: при создании панель получает его с точностью до дня
+            await self.outbox.enqueue_syncs([uuid])
+
+    @staticmethod
+    def render(report, limit=5):
+        lines = [
+            f"🔍 Сверка БД и панели{'' if report['applied'] else ' (пробный прогон)'} за {report['duration']:.1f} с",
+            f"• Пользователей: {report['users']}, клиентов в панели: {report['clients']}, "
+            f"в очереди: {report['pending']}",
+        ]
+        if report["skipped_nodes"]:
+            lines.append(f"⚠️ Узлы без ответа: {', '.join(report['skipped_nodes'])}")
+        sections = (
+            ("🗑 Сироты в панели", report["orphans"], lambda o: f"{o[0]}: {o[2]}"),
+            ("❓ Нет в панели", report["missing"], lambda m: f"{m[0]} ({m[2]})"),
+            ("⚖️ Расхождения", report["mismatched"], lambda m: f"{m[0]}: {', '.join(m[3])}"),
+            ("🔀 Сменили узел", report["moved"], lambda m: f"{m[0]}: {m[2]} → {m[3]}"),
+            ("👥 Дубли UUID", report["duplicates"], lambda d: f"{d[0]}: {', '.join(d[2])}"),
+        )
+        for title, items, describe in sections:
+            if items:
+                lines.append(f"{title}: {len(items)}")
+                lines.extend(f"  {describe(item)}" for item in items[:limit])
+        if not any(items for _, items, _ in sections):
+            lines.append("✅ Расхождений нет")
+        elif not report["applied"]:
+            lines.append("Исправить: /reconcile apply")
+        return "\n".join(lines)
@@ -0,0 +1,35 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+DAY = 86400
+
+
+class Renewals:
+    # Продление пишет новый срок в БД вместе с заданием для панели; в панель его доносит PanelOutbox
+    def __init__(self, db, outbox):
+        self.db = db
+        self.outbox = outbox
+
+    async def renew(self, user, days, extra_gb):
+        # Новый срок считается один раз от сохранённого и одинаково пишется в БД и в панель
+        expire_date = max(user['expire_date'], int(time.time())) + days * DAY
+        traffic_limit = user['traffic_limit'] + extra_gb * GB
+        if not await self.db.renew_user(user['user_id'], traffic_limit, expire_date, user['node'], user['uuid']):
+            return None
+        self.outbox.notify()
+        return expire_date, traffic_limit
+
+    async def extend_all(self, days):
+        started = time.monotonic()
+        count = await self.db.extend_active_users(days * DAY)
+        if count is None:
+            return None
+        self.outbox.notify()
+        logger.info(
+            "Массовое продление на %s дн.: %s пользователей поставлено в очередь панели за %.3f с",
+            days, count, time.monotonic() - started
+        )
+        return count
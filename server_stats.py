@@ -0,0 +1,94 @@
+import time
+import heapq
+import asyncio
+import logging
+from collections import deque
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class StatsSampler:
+    def __init__(self, pool, history=60, top_n=5):
+        self.pool = pool
+        self.top_n = top_n
+        # Кольцевой буфер последних снимков: админ-панель читает только его
+        self.samples = deque(maxlen=history)
+        self._last_usage = {}
+
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    async def run(self, context=None):
+        try:
+            sample = await self._collect()
+        except Exception as e:
+            logger.error("Ошибка сбора статистики сервера: %s", e)
+            return
+        self.samples.append(sample)
+
+    async def _collect(self):
+        # psutil читает /proc синхронно — уводим в поток, cpu_percent(None) считает с прошлого вызова
+        cpu, ram = await asyncio.to_thread(lambda: (psutil.cpu_percent(None), psutil.virtual_memory().percent))
+
+        upload = download = inbounds = 0
+        usage = {}
+        nodes = self.pool.healthy_nodes()
+        await asyncio.gather(*(node.api.get_inbounds() for node in nodes))
+        for node in nodes:
+            for inbound in node.api.index.list():
+                upload += inbound.get("up", 0)
+                download += inbound.get("down", 0)
+                inbounds += 1
+                for stat in inbound.get("clientStats") or []:
+                    usage[stat.get("email")] = stat.get("up", 0) + stat.get("down", 0)
+
+        now = time.time()
+        previous = self.latest()
+        elapsed = now - previous["ts"] if previous else 0
+        if previous and elapsed > 0:
+            up_rate = max(0, upload - previous["upload"]) / elapsed
+            down_rate = max(0, download - previous["download"]) / elapsed
+            # Лидеры — по трафику за интервал; в первом снимке интервала ещё нет, берём накопленный
+            consumed = {email: total - self._last_usage.get(email, 0) for email, total in usage.items()}
+        else:
+            up_rate = down_rate = 0.0
+            consumed = usage
+        top = heapq.nlargest(self.top_n, ((used, email) for email, used in consumed.items() if used > 0))
+        self._last_usage = usage
+
+        return {
+            "ts": now,
+            "cpu": cpu,
+            "ram": ram,
+            "upload": upload,
+            "download": download,
+            "up_rate": up_rate,
+            "down_rate": down_rate,
+            "inbounds": inbounds,
+            "clients": len(usage),
+            "nodes": len(nodes),
+            "nodes_total": len(self.pool.nodes),
+            "top": [(email, used) for used, email in top],
+        }
+
+    def render(self):
+        sample = self.latest()
+        if sample is None:
+            return "📈 Статистика сервера ещё собирается"
+
+        gb = 1024 ** 3
+        cpu_avg = sum(s["cpu"] for s in self.samples) / len(self.samples)
+        lines = [
+            f"📈 Сервер ({int(time.time() - sample['ts'])} с назад)",
+            f"• CPU: {sample['cpu']:.0f}% (среднее {cpu_avg:.0f}% за {len(self.samples)} замеров)",
+            f"• RAM: {sample['ram']:.0f}%",
+            f"• Узлы: {sample['nodes']}/{sample['nodes_total']}, inbounds: {sample['inbounds']}, "
+            f"клиентов: {sample['clients']}",
+            f"• Трафик: ↑ {sample['upload'] / gb:.1f} ГБ, ↓ {sample['download'] / gb:.1f} ГБ",
+            f"• Скорость: ↑ {sample['up_rate'] * 8 / 1e6:.1f} Мбит/с, ↓ {sample['down_rate'] * 8 / 1e6:.1f} Мбит/с",
+        ]
+        if sample["top"]:
+            lines.append("🔝 Больше всего трафика:")
+            lines.extend(f"  {email} — {used / gb:.2f} ГБ" for email, used in sample["top"])
+        return "\n".join(lines)
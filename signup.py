@@ -0,0 +1,114 @@
+import asyncio
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class SignupPipeline:
+    def __init__(self, db, pool, outbox, traffic_gb, days, workers=8, queue_size=1000):
+        self.db = db
+        self.pool = pool
+        self.outbox = outbox
+        self.traffic_gb = traffic_gb
+        self.days = days
+        self.workers = workers
+        # Ограниченная очередь сглаживает всплески: при переполнении регистрация откладывается
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._inflight = {}
+        self._tasks = []
+
+    async def start(self):
+        await self.recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("Конвейер регистраций запущен: %s обработчиков", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def signup(self, user_id, username):
+        # Повторное нажатие /start ждёт уже идущую регистрацию, а не запускает вторую
+        inflight = self._inflight.get(user_id)
+        if inflight is not None:
+            await asyncio.shield(inflight)
+            return "exists", None
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((user_id, username, future))
+        except asyncio.QueueFull:
+            logger.warning("Очередь регистраций переполнена, пользователь %s отложен", user_id)
+            return "busy", None
+
+        self._inflight[user_id] = future
+        return await asyncio.shield(future)
+
+    async def recover(self):
+        # Записи, оставшиеся после падения: пользователь либо создан, либо ресурс панели откатывается
+        for pending in await self.db.get_pending_signups():
+            if not await self.db.user_exists(pending["user_id"]):
+                if pending["node"] is not None:
+                    await self.outbox.enqueue([(pending["node"], pending["uuid"], "delete", None, None)])
+                else:
+                    await self.pool.delete_everywhere(pending["uuid"])
+                logger.warning("Откат незавершенной регистрации пользователя %s", pending['user_id'])
+            await self.db.delete_pending_signup(pending["user_id"])
+
+    async def _worker(self):
+        while True:
+            user_id, username, future = await self._queue.get()
+            try:
+                result = await self._provision(user_id, username)
+            except Exception as e:
+                logger.error("Неожиданная ошибка регистрации пользователя %s: %s", user_id, e)
+                result = ("failed", None)
+            finally:
+                self._queue.task_done()
+            if not future.done():
+                future.set_result(result)
+            self._inflight.pop(user_id, None)
+
+    async def _provision(self, user_id, username):
+        if await self.db.user_exists(user_id):
+            return "exists", None
+        if not await self.pool.is_healthy():
+            return "unavailable", None
+
+        client_id = str(uuid.uuid4())
+        if not await self.db.add_pending_signup(user_id, client_id):
+            return "busy", None
+
+        result = await self.pool.create_user(
+            remark=f"user_{user_id}",
+            traffic_gb=self.traffic_gb,
+            expire_days=self.days,
+            client_id=client_id
+        )
+        if not result:
+            # Панель могла создать клиента, но не ответить — чистим по UUID
+            await self.pool.delete_everywhere(client_id)
+            await self.db.delete_pending_signup(user_id)
+            return "failed", None
+
+        node, client_id, port = result
+        await self.db.set_pending_signup_node(user_id, node)
+        created = await self.db.create_user(
+            user_id=user_id,
+            username=username,
+            uuid=client_id,
+            traffic_limit=self.traffic_gb * 1024 ** 3,
+            expire_date=int((datetime.now() + timedelta(days=self.days)).timestamp()),
+            node=node
+        )
+        if not created:
+            logger.error("Откат клиента %s на узле %s: не удалось сохранить пользователя %s", client_id, node, user_id)
+            await self.outbox.enqueue([(node, client_id, "delete", None, None)])
+            await self.db.delete_pending_signup(user_id)
+            return "failed", None
+
+        await self.db.delete_pending_signup(user_id)
+        return "created", self.pool.generate_config(node, client_id, port)
@@ -0,0 +1,89 @@
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+
+class TrafficHistory:
+    # Работает поверх соединений Database; вызывается из пула потоков через AsyncDatabase.run
+    def __init__(self, db, raw_retention=6 * HOUR, hourly_retention=7 * DAY, daily_retention=365 * DAY):
+        self.db = db
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.daily_retention = daily_retention
+
+    def record(self, deltas, ts):
+        # deltas: [(user_id, bytes), ...]; агрегаты обновляются в той же транзакции, что и сырые записи
+        hour = ts - ts % HOUR
+        day = ts - ts % DAY
+        try:
+            with self.db.conn as conn:
+                conn.executemany(
+                    "INSERT INTO traffic_raw (user_id, ts, bytes) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, ts) DO UPDATE SET bytes = bytes + excluded.bytes",
+                    [(user_id, ts, used) for user_id, used in deltas]
+                )
+                conn.executemany(
+                    "INSERT INTO traffic_hourly (user_id, bucket, bytes) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, bucket) DO UPDATE SET bytes = bytes + excluded.bytes",
+                    [(user_id, hour, used) for user_id, used in deltas]
+                )
+                conn.executemany(
+                    "INSERT INTO traffic_daily (user_id, bucket, bytes) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, bucket) DO UPDATE SET bytes = bytes + excluded.bytes",
+                    [(user_id, day, used) for user_id, used in deltas]
+                )
+            logger.debug("Записано приращений трафика: %s", len(deltas))
+            return True
+        except sqlite3.Error as e:
+            logger.error("Ошибка записи истории трафика: %s", e)
+            return False
+
+    def prune(self, now):
+        try:
+            with self.db.conn as conn:
+                removed = sum(
+                    conn.execute(f"DELETE FROM {table} WHERE {column} < ?", (now - retention,)).rowcount
+                    for table, column, retention in (
+                        ("traffic_raw", "ts", self.raw_retention),
+                        ("traffic_hourly", "bucket", self.hourly_retention),
+                        ("traffic_daily", "bucket", self.daily_retention),
+                    )
+                )
+            if removed:
+                logger.info("Удалено устаревших записей истории трафика: %s", removed)
+            return removed
+        except sqlite3.Error as e:
+            logger.error("Ошибка очистки истории трафика: %s", e)
+            return None
+
+    def daily_usage(self, user_id, since):
+        # Поиск по первичному ключу (user_id, bucket)
+        try:
+            return self.db.conn.execute(
+                "SELECT bucket, bytes FROM traffic_daily WHERE user_id = ? AND bucket >= ? ORDER BY bucket",
+                (user_id, since - since % DAY)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения истории трафика пользователя %s: %s", user_id, e)
+            return []
+
+    def top_users(self, since, now, limit=10):
+        # Окно внутри срока хранения сырых данных считается точно, более длинное — по часовым агрегатам
+        if since >= now - self.raw_retention:
+            table, column, start = "traffic_raw", "ts", since
+        else:
+            table, column, start = "traffic_hourly", "bucket", since - since % HOUR
+        try:
+            # Без INDEXED BY планировщик предпочитает полный проход по первичному ключу ради GROUP BY
+            return self.db.conn.execute(
+                f"SELECT user_id, SUM(bytes) AS bytes FROM {table} INDEXED BY idx_{table}_{column} WHERE {column} >= ? "
+                f"GROUP BY user_id ORDER BY bytes DESC LIMIT ?",
+                (start, limit)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Ошибка получения лидеров по трафику: %s", e)
+            return []
@@ -0,0 +1,53 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficSync:
+    def __init__(self, db, pool, history=None):
+        self.db = db
+        self.pool = pool
+        self.history = history
+        self.last_duration = None
+        self.last_changed = 0
+        # Пользователи с нулевым счётчиком в панели: в БД для них нет записи, но замер уже был
+        self._sampled = set()
+
+    async def run(self, context=None):
+        started = time.monotonic()
+        usage = await self.pool.get_client_traffic()
+        if usage is None:
+            logger.warning("Синхронизация трафика пропущена: панель недоступна")
+            return
+
+        # Пишем только строки, у которых трафик действительно изменился
+        changed = []
+        deltas = []
+        async for user_id, uuid, traffic_used in self.db.iter_users(columns=('user_id', 'uuid', 'traffic_used')):
+            if uuid not in usage:
+                continue
+            # Нулевой traffic_used, не виденный раньше, — это не предыдущий замер: первый замер
+            # становится точкой отсчёта, иначе весь накопленный счётчик попал бы в текущий час и день
+            sampled = traffic_used > 0 or user_id in self._sampled
+            if usage[uuid] == 0:
+                self._sampled.add(user_id)
+            else:
+                self._sampled.discard(user_id)
+            if usage[uuid] != traffic_used:
+                changed.append((usage[uuid], user_id))
+                # Счётчик в панели мог быть сброшен — тогда весь новый объём считается приращением
+                delta = usage[uuid] - traffic_used if usage[uuid] > traffic_used else usage[uuid]
+                if sampled and delta > 0:
+                    deltas.append((user_id, delta))
+        if changed and not await self.db.update_traffic_bulk(changed):
+            return
+        if self.history is not None and deltas:
+            await self.db.run(self.history.record, deltas, int(time.time()))
+
+        self.last_duration = time.monotonic() - started
+        self.last_changed = len(changed)
+        logger.info(
+            "Синхронизация трафика: изменено %s из %s клиентов за %.3f с",
+            self.last_changed, len(usage), self.last_duration
+        )
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Счётчик изменений: прогрев не кладёт страницу, если за время её чтения записи менялись
+        self.writes = 0
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, user):
+        self._entries[user_id] = (time.monotonic(), dict(user))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        # Запись сквозь кэш: обновляем только уже закэшированные записи, TTL не продлеваем
+        self.writes += 1
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, user_id):
+        self.writes += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self.writes += 1
+        self._entries.clear()
+
+    def warm(self, users):
+        # Не вытесняет и не перезаписывает записи, которые уже положили обработчики
+        for user in users:
+            if len(self._entries) >= self.max_size:
+                return
+            if user['user_id'] not in self._entries:
+                self._entries[user['user_id']] = (time.monotonic(), dict(user))
+                self._entries.move_to_end(user['user_id'], last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,86 @@
+import time
+import asyncio
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    # Фоновый прогрев после старта: приложение Telegram уже принимает обновления,
+    # а вход в панель, индекс inbounds и кэш пользователей заполняются параллельно
+    def __init__(self, db, pool, signup, started=None, page_size=1000, retry_max=30):
+        self.db = db
+        self.pool = pool
+        self.signup = signup
+        self.started = started if started is not None else time.monotonic()
+        self.page_size = page_size
+        self.retry_max = retry_max
+        self.panel_ready = False
+        self._ready = asyncio.Event()
+        self._task = None
+        metrics.READY.set(0)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def wait_ready(self, timeout=None):
+        await asyncio.wait_for(self._ready.wait(), timeout)
+
+    def _mark(self, phase):
+        elapsed = time.monotonic() - self.started
+        metrics.STARTUP_SECONDS.set(elapsed, phase=phase)
+        return elapsed
+
+    async def _run(self):
+        self._mark("application")
+        panel, users = await asyncio.gather(self._warm_panel(), self._warm_users())
+        total = self._mark("ready")
+        metrics.READY.set(1)
+        self._ready.set()
+        logger.info(
+            "Бот готов к работе за %.2f с (панель: %.2f с, кэш пользователей: %s за %.2f с)",
+            total, panel, users[0], users[1]
+        )
+
+    async def _warm_panel(self):
+        # Пока ни один узел не отвечает, повторяем с растущей паузой; регистрации ждут этого шага
+        delay = 1
+        # force: кэшированный результат неудачной проверки не должен задерживать повтор
+        while not await self.pool.check_health(force=True):
+            logger.warning("Панель X-UI недоступна при запуске, повтор через %s с", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+        self._mark("panel")
+        # Откат незавершённых регистраций требует панели, поэтому конвейер стартует только сейчас
+        await self.signup.start()
+        self.panel_ready = True
+        return self._mark("signup")
+
+    async def _warm_users(self):
+        cache = self.db.cache
+        if cache is None:
+            return 0, self._mark("users")
+        after_id = None
+        while len(cache) < cache.max_size:
+            writes = cache.writes
+            page = await self.db.get_users_page(
+                after_id, min(self.page_size, cache.max_size - len(cache)), active_only=True
+            )
+            # Запись, изменённая во время чтения страницы, могла устареть — такую страницу пропускаем
+            if cache.writes == writes:
+                cache.warm(page)
+            if len(page) < self.page_size:
+                break
+            after_id = page[-1]['user_id']
+        return len(cache), self._mark("users")
@@ -0,0 +1,128 @@
+import json
+import asyncio
+import hmac
+import secrets
+import logging
+from telegram import Update
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    # Минимальное ASGI-приложение: принимает обновления Telegram и кладёт их в ограниченную update_queue
+    def __init__(self, application, path, secret_token, max_body=1024 * 1024):
+        # Без секрета любой, кто достучится до порта, подделает обновление от имени администратора
+        if not secret_token:
+            raise ValueError("Webhook требует secret_token")
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] != self.path:
+            await self._respond(send, 404)
+            return
+        if scope["method"] != "POST":
+            await self._respond(send, 405)
+            return
+        headers = dict(scope["headers"])
+        # Сравниваются байты: compare_digest не принимает строки с не-ASCII символами
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if not hmac.compare_digest(token, self.secret_token.encode()):
+            logger.warning("Запрос к webhook с неверным секретом от %s", scope.get("client"))
+            await self._respond(send, 403)
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > self.max_body:
+                await self._respond(send, 413)
+                return
+            if not message.get("more_body"):
+                break
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning("Некорректное обновление в webhook: %s", e)
+            await self._respond(send, 400)
+            return
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже: очередь не растёт, а задержка не копится
+            metrics.WEBHOOK_REJECTED.inc()
+            await self._respond(send, 503)
+            return
+        await self._respond(send, 200)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _respond(send, status):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain"), (b"content-length", b"0")],
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def run_webhook(application, config, post_init, post_shutdown):
+    # uvicorn нужен только в режиме webhook
+    import uvicorn
+
+    path = config.get('WEBHOOK_PATH', '/telegram')
+    secret_token = config.get('WEBHOOK_SECRET')
+    if not secret_token:
+        # Случайный секрет на время работы процесса: Telegram получает его в set_webhook ниже
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, сгенерирован секрет на время работы процесса")
+    server = uvicorn.Server(uvicorn.Config(
+        WebhookServer(application, path, secret_token),
+        host=config.get('WEBHOOK_HOST', '0.0.0.0'),
+        port=config.get('WEBHOOK_PORT', 8443),
+        log_level="warning",
+        access_log=False,
+        timeout_graceful_shutdown=config.get('WEBHOOK_DRAIN_TIMEOUT', 30)
+    ))
+
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.bot.set_webhook(
+            url=config['WEBHOOK_URL'].rstrip('/') + path,
+            secret_token=secret_token,
+            max_connections=config.get('WEBHOOK_MAX_CONNECTIONS', 40),
+            allowed_updates=Update.ALL_TYPES
+        )
+        await application.start()
+        logger.info("Webhook принимает обновления на %s:%s%s", server.config.host, server.config.port, path)
+        try:
+            # serve() возвращается по SIGINT/SIGTERM, после того как HTTP-сервер перестал принимать запросы
+            await server.serve()
+        finally:
+            logger.info("Завершение: обработка оставшихся обновлений (%s в очереди)", application.update_queue.qsize())
+            await application.stop()
+    finally:
+        await application.shutdown()
+        await post_shutdown(application)
@@ -1,306 +1,644 @@
-import requests
+import asyncio
+import contextlib
+import copy
+import httpx
 import json
 import uuid
 import logging
-import psutil
-import urllib3
+import time
+import metrics
 from datetime import datetime, timedelta
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from inbound_index import InboundIndex
+from port_allocator import PortAllocator
 
 logger = logging.getLogger(__name__)
 
 
-class XUIAPI:
-    def __init__(self, panel_url, username, password, api_prefix=""):
+class _ModifyLock:
+    # Одиночные addClient/delClient идут параллельно друг с другом, пакет изменений — исключительно.
+    # Ждущий пакет пропускается вперёд новых одиночных запросов, иначе поток регистраций его бы не пустил
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._waiting += 1
+            try:
+                await self._cond.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class _XUIBase:
+    HEADERS = {
+        "User-Agent": "Mozilla/5.0",
+        "X-Requested-With": "XMLHttpRequest"
+    }
+
+    def __init__(self, panel_url, username, password, api_prefix="", cache_ttl=60, port_range=(21000, 30000),
+                 shared_inbounds=None, shared_capacity=500, public_host="divan4ikbmstu.online"):
         self.panel_url = panel_url.rstrip('/')
+        self.public_host = public_host
         self.api_prefix = api_prefix.strip('/')
         self.username = username
         self.password = password
-        self.session = requests.Session()
-        self._login()
+        self.index = InboundIndex(cache_ttl)
+        self.ports = PortAllocator(*port_range)
+        # Общие inbounds: клиенты добавляются в них вместо отдельного inbound на пользователя
+        self.shared_inbounds = list(shared_inbounds or [])
+        self.shared_capacity = shared_capacity
+
+    def _url(self, endpoint):
+        return f"{self.panel_url}/{self.api_prefix}{endpoint}"
+
+    @staticmethod
+    def _parse_settings(inbound):
+        settings = inbound.get("settings", {})
+        if isinstance(settings, str):
+            settings = json.loads(settings)
+        return settings
+
+    @staticmethod
+    def _serialize_inbound(inbound):
+        data = {k: v for k, v in inbound.items() if k not in ["id", "inbound_id"]}
+        for field in ["settings", "streamSettings", "sniffing", "allocate"]:
+            if field in data and isinstance(data[field], dict):
+                data[field] = json.dumps(data[field])
+        return data
+
+    @staticmethod
+    def _new_client(client_id, email, traffic_gb, expire_timestamp):
+        return {
+            "id": client_id,
+            "flow": "xtls-rprx-vision",
+            "email": email,
+            "limitIp": 0,
+            "totalGB": traffic_gb,
+            "expiryTime": expire_timestamp,
+            "enable": True
+        }
+
+    @staticmethod
+    def _build_user_inbound(base_inbound, client_id, email, port, traffic_gb, expire_timestamp):
+        inbound = copy.deepcopy(base_inbound)
+        settings = _XUIBase._parse_settings(inbound)
+        settings["clients"] = [_XUIBase._new_client(client_id, email, traffic_gb, expire_timestamp)]
+
+        inbound["settings"] = settings
+        inbound["port"] = port
+        inbound["expiryTime"] = expire_timestamp
+        inbound.pop("id", None)
+        inbound.pop("inbound_id", None)
+        return inbound
+
+    @staticmethod
+    def _observe(endpoint, result, started):
+        status = "ok" if isinstance(result, dict) and result.get("success") else "error"
+        metrics.XUI_LATENCY.observe(
+            time.perf_counter() - started, endpoint=metrics.endpoint_label(endpoint), status=status
+        )
+
+    @staticmethod
+    def _get_client(inbound, uuid):
+        return next(c for c in inbound["settings"].get("clients", []) if c.get("id") == uuid)
+
+    def _apply_client_update(self, inbound, uuid, traffic_gb=None, expiry_time=None):
+        client = self._get_client(inbound, uuid)
+        updated = False
+
+        if traffic_gb is not None:
+            client["totalGB"] = traffic_gb
+            updated = True
+
+        # expiry_time — абсолютный срок в секундах, его считает вызывающая сторона
+        # по сохранённой дате, чтобы в БД и в панели оказалось одно и то же значение
+        if expiry_time is not None:
+            new_expire = int(expiry_time * 1000)
+            client["expiryTime"] = new_expire
+            if not self._is_shared(inbound):
+                inbound["expiryTime"] = new_expire
+            updated = True
+
+        if updated:
+            # Продление снимает блокировку, выставленную при отключении
+            client["enable"] = True
+            if not self._is_shared(inbound):
+                inbound["enable"] = True
+        return updated
+
+    def _group_by_inbound(self, uuids):
+        groups = {}
+        missing = []
+        for uuid in uuids:
+            found = self.index.get_by_uuid(uuid)
+            if found is None:
+                missing.append(uuid)
+            else:
+                groups.setdefault(found[0]["id"], []).append(uuid)
+        return groups, missing
+
+    def _is_shared(self, inbound):
+        return inbound.get("id") in self.shared_inbounds
+
+    def _pick_shared_inbound(self):
+        # Наименее заполненный общий inbound, в котором ещё есть место
+        best = None
+        best_count = None
+        for inbound_id in self.shared_inbounds:
+            inbound = self.index.get(inbound_id)
+            if inbound is None:
+                continue
+            count = len(inbound["settings"].get("clients", []))
+            if count < self.shared_capacity and (best is None or count < best_count):
+                best, best_count = inbound, count
+        return best
+
+    @staticmethod
+    def _client_payload(inbound_id, client):
+        return {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
+
+    def _cache_client(self, inbound, client=None, remove_uuid=None):
+        # Точечно обновляем общий inbound в индексе после подтверждения панелью
+        inbound = copy.deepcopy(inbound)
+        clients = [c for c in inbound["settings"].get("clients", [])
+                   if c.get("id") not in (remove_uuid, client and client.get("id"))]
+        if client is not None:
+            clients.append(client)
+        inbound["settings"]["clients"] = clients
+        self.index.put(inbound)
+
+    @staticmethod
+    def _is_port_conflict(result):
+        msg = str(result.get("msg", "")).lower()
+        return "port" in msg and "exist" in msg
+
+    def _cache_created_inbound(self, result):
+        # Панель возвращает созданный inbound в obj — кладём его в индекс без перезагрузки списка
+        created = result.get("obj")
+        if isinstance(created, dict) and created.get("id") is not None:
+            self.index.put(created)
+        else:
+            self.index.invalidate()
+
+    def _collect_client_traffic(self):
+        # clientStats приходят вместе со списком inbounds и связаны с клиентами по email
+        usage = {}
+        for inbound in self.index.list():
+            for stat in inbound.get("clientStats") or []:
+                found = self.index.get_by_email(stat.get("email"))
+                if found:
+                    usage[found[1]["id"]] = stat.get("up", 0) + stat.get("down", 0)
+        return usage
 
-    def _login(self):
+    def generate_config(self, uuid, port):
+        config = (
+            f"vless://{uuid}@{self.public_host}:{port}?"
+            f"encryption=none&flow=xtls-rprx-vision&security=tls&"
+            f"sni={self.public_host}&fp=chrome&"
+            f"type=tcp&headerType=none#{uuid[:8]}"
+        )
+        logger.debug("Сгенерирована конфигурация для %s", uuid)
+        return config
+
+
+class AsyncXUIAPI(_XUIBase):
+    def __init__(self, panel_url, username, password, api_prefix="",
+                 timeout=15, max_connections=20, max_concurrency=10, transport=None,
+                 session_ttl=3600, health_ttl=30, **kwargs):
+        super().__init__(panel_url, username, password, api_prefix, **kwargs)
+        self.timeout = timeout
+        # Сессия панели: cookie живёт session_ttl секунд, обновляем её заранее, за 10% до истечения
+        self.session_ttl = session_ttl
+        self.health_ttl = health_ttl
+        self._session_started = None
+        self._session_generation = 0
+        self._login_failed_at = None
+        self._login_lock = asyncio.Lock()
+        self._health = None
+        # Один пул keep-alive соединений на всё приложение
+        self.client = httpx.AsyncClient(
+            headers=self.HEADERS,
+            verify=False,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 10)),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            transport=transport
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._refresh_lock = asyncio.Lock()
+        self._ports_lock = asyncio.Lock()
+        self._modify_lock = _ModifyLock()
+
+    async def close(self):
+        await self.client.aclose()
+        logger.info("Соединения с X-UI закрыты")
+
+    async def _send(self, method, url, **kwargs):
+        async with self._semaphore:
+            return await self.client.request(method, url, **kwargs)
+
+    def _session_valid(self):
+        return (
+            self._session_started is not None
+            and time.monotonic() - self._session_started < self.session_ttl * 0.9
+        )
+
+    async def ensure_session(self, seen_generation=None):
+        if seen_generation is None:
+            if self._session_valid():
+                return True
+            seen_generation = self._session_generation
+
+        # Single-flight: при пачке 401 в панель уходит один вход, остальные ждут его результата
+        async with self._login_lock:
+            if self._session_generation != seen_generation:
+                return self._session_valid()
+            if self._login_failed_at is not None and time.monotonic() - self._login_failed_at < 5:
+                return False
+            return await self._login()
+
+    async def _login(self):
         try:
-            url = f"{self.panel_url}/{self.api_prefix}/login"
+            url = self._url("/login")
             data = {"username": self.username, "password": self.password}
-            logger.info(f"Попытка входа в X-UI панель: {url}")
+            logger.info("Попытка входа в X-UI панель: %s", url)
 
-            response = self.session.post(url, json=data, verify=False, timeout=10)
+            response = await asyncio.wait_for(self._send("POST", url, json=data), self.timeout)
             response.raise_for_status()
 
             result = response.json()
             if result.get("success"):
+                self._session_started = time.monotonic()
+                self._session_generation += 1
+                self._login_failed_at = None
                 logger.info("Успешная аутентификация в X-UI")
                 return True
 
             error_msg = result.get("msg", "Неизвестная ошибка")
-            logger.error(f"Ошибка входа: {error_msg}")
+            logger.error("Ошибка входа: %s", error_msg)
+            self._login_failed_at = time.monotonic()
             return False
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка сети при входе: {str(e)}")
+        except asyncio.TimeoutError:
+            logger.error("Превышено время ожидания входа (%s с)", self.timeout)
+        except httpx.HTTPError as e:
+            logger.error("Ошибка сети при входе: %s", e)
         except json.JSONDecodeError:
             logger.error("Неверный JSON-ответ при входе")
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при входе: {str(e)}")
+            logger.error("Неожиданная ошибка при входе: %s", e)
+        self._login_failed_at = time.monotonic()
         return False
 
-    def _request(self, method, endpoint, data=None, params=None):
+    async def _request(self, method, endpoint, data=None, params=None):
+        started = time.perf_counter()
+        result = await self._call(method, endpoint, data, params)
+        self._observe(endpoint, result, started)
+        return result
+
+    async def _call(self, method, endpoint, data=None, params=None, _retry=True):
         try:
-            url = f"{self.panel_url}/{self.api_prefix}{endpoint}"
-            logger.debug(f"Отправка запроса: {method} {url}")
-
-            headers = {
-                "User-Agent": "Mozilla/5.0",
-                "X-Requested-With": "XMLHttpRequest"
-            }
-
-            response = self.session.request(
-                method, url,
-                json=data,
-                params=params,
-                headers=headers,
-                timeout=15,
-                verify=False
+            url = self._url(endpoint)
+            logger.debug("Отправка запроса: %s %s", method, url)
+
+            generation = self._session_generation
+            if not self._session_valid() and not await self.ensure_session(generation):
+                return {"success": False, "msg": "Ошибка входа"}
+            generation = self._session_generation
+
+            # Дедлайн включает ожидание свободного слота в семафоре
+            response = await asyncio.wait_for(
+                self._send(method, url, json=data, params=params),
+                self.timeout
             )
 
             if response.status_code == 401:
                 logger.warning("Требуется повторная аутентификация (401)")
-                if self._login():
-                    return self._request(method, endpoint, data, params)
+                self._session_started = None
+                if _retry and await self.ensure_session(generation):
+                    return await self._call(method, endpoint, data, params, _retry=False)
                 return {"success": False, "msg": "Ошибка повторного входа"}
 
             return response.json()
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка сети при запросе {endpoint}: {str(e)}")
+        except asyncio.TimeoutError:
+            logger.error("Превышено время ожидания запроса %s (%s с)", endpoint, self.timeout)
+            return {"success": False, "msg": "Timeout"}
+        except httpx.HTTPError as e:
+            logger.error("Ошибка сети при запросе %s: %s", endpoint, e)
             return {"success": False, "msg": str(e)}
         except json.JSONDecodeError:
-            logger.error(f"Не удалось декодировать JSON для {endpoint}")
+            logger.error("Не удалось декодировать JSON для %s", endpoint)
             return {"success": False, "msg": "Invalid JSON response"}
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при запросе {endpoint}: {str(e)}")
+            logger.error("Неожиданная ошибка при запросе %s: %s", endpoint, e)
             return {"success": False, "msg": str(e)}
 
-    def get_inbounds(self):
-        result = self._request("GET", "/panel/api/inbounds/list")
-        if result.get("success"):
-            inbounds = result.get("obj", [])
-            logger.debug(f"Получено {len(inbounds)} inbounds")
-            return inbounds
+    async def get_inbounds(self, force=False):
+        if not force and self.index.is_fresh():
+            return self.index.list()
 
-        logger.error(f"Ошибка получения inbounds: {result.get('msg', 'Неизвестная ошибка')}")
+        generation = self.index.generation
+        async with self._refresh_lock:
+            # Пока ждали блокировку, список мог обновить параллельный запрос
+            if self.index.generation != generation and self.index.is_fresh():
+                return self.index.list()
+
+            result = await self._request("GET", "/panel/api/inbounds/list")
+            if result.get("success"):
+                inbounds = result.get("obj", [])
+                logger.debug("Получено %s inbounds", len(inbounds))
+                self.index.load(inbounds)
+                return self.index.list()
+
+        self.index.invalidate()
+        logger.error("Ошибка получения inbounds: %s", result.get('msg', 'Неизвестная ошибка'))
         return []
 
-    def create_inbound(self, data):
-        result = self._request("POST", "/panel/api/inbounds/add", data=data)
+    async def create_inbound(self, data):
+        result = await self._request("POST", "/panel/api/inbounds/add", data=data)
+        if result.get("success"):
+            logger.info("Создан новый inbound: %s", data.get('remark', 'Без названия'))
+        else:
+            logger.error("Ошибка создания inbound: %s", result.get('msg', 'Неизвестная ошибка'))
+        return result
+
+    async def update_inbound(self, inbound_id, data):
+        result = await self._request("POST", f"/panel/api/inbounds/update/{inbound_id}", data=data)
+        if result.get("success"):
+            logger.info("Обновлен inbound %s", inbound_id)
+        else:
+            logger.error("Ошибка обновления inbound %s: %s", inbound_id, result.get('msg', 'Неизвестная ошибка'))
+        return result
+
+    async def del_inbound(self, inbound_id):
+        result = await self._request("POST", f"/panel/api/inbounds/del/{inbound_id}")
         if result.get("success"):
-            logger.info(f"Создан новый inbound: {data.get('remark', 'Без названия')}")
+            logger.info("Удален inbound %s", inbound_id)
         else:
-            logger.error(f"Ошибка создания inbound: {result.get('msg', 'Неизвестная ошибка')}")
+            logger.error("Ошибка удаления inbound %s: %s", inbound_id, result.get('msg', 'Неизвестная ошибка'))
         return result
 
-    def update_inbound(self, inbound_id, data):
-        result = self._request("POST", f"/panel/api/inbounds/update/{inbound_id}", data=data)
+    async def add_client(self, inbound_id, client):
+        result = await self._request("POST", "/panel/api/inbounds/addClient",
+                               data=self._client_payload(inbound_id, client))
         if result.get("success"):
-            logger.info(f"Обновлен inbound {inbound_id}")
+            logger.info("Клиент %s добавлен в inbound %s", client['id'], inbound_id)
         else:
-            logger.error(f"Ошибка обновления inbound {inbound_id}: {result.get('msg', 'Неизвестная ошибка')}")
+            logger.error("Ошибка добавления клиента в inbound %s: %s", inbound_id, result.get('msg', 'Неизвестная ошибка'))
         return result
 
-    def del_inbound(self, inbound_id):
-        result = self._request("POST", f"/panel/api/inbounds/del/{inbound_id}")
+    async def del_client(self, inbound_id, client_id):
+        result = await self._request("POST", f"/panel/api/inbounds/{inbound_id}/delClient/{client_id}")
         if result.get("success"):
-            logger.info(f"Удален inbound {inbound_id}")
+            logger.info("Клиент %s удален из inbound %s", client_id, inbound_id)
         else:
-            logger.error(f"Ошибка удаления inbound {inbound_id}: {result.get('msg', 'Неизвестная ошибка')}")
+            logger.error("Ошибка удаления клиента %s: %s", client_id, result.get('msg', 'Неизвестная ошибка'))
         return result
 
-    def create_user(self, remark, traffic_gb=40, expire_days=30):
+    async def _find_user_inbound(self, uuid):
+        refreshed = not self.index.is_fresh()
+        if refreshed:
+            await self.get_inbounds(force=True)
+
+        found = self.index.get_by_uuid(uuid)
+        if found is None and not refreshed:
+            # Промах по свежему индексу — клиент мог появиться в панели в обход бота
+            await self.get_inbounds(force=True)
+            found = self.index.get_by_uuid(uuid)
+        return found[0] if found else None
+
+    async def create_user(self, remark, traffic_gb=40, expire_days=30, client_id=None):
         try:
-            client_id = str(uuid.uuid4())
+            client_id = client_id or str(uuid.uuid4())
             email = f"{remark}_{client_id[:8]}@vpn.com"
-            logger.info(f"Создание пользователя: {remark}, трафик: {traffic_gb}GB, срок: {expire_days} дней")
+            logger.info("Создание пользователя: %s, трафик: %sGB, срок: %s дней", remark, traffic_gb, expire_days)
 
             expire_timestamp = int((datetime.now() + timedelta(days=expire_days)).timestamp() * 1000)
-            inbounds = self.get_inbounds()
+            inbounds = await self.get_inbounds()
+            if self.shared_inbounds:
+                return await self._create_shared_client(client_id, email, traffic_gb, expire_timestamp)
 
             if not inbounds:
                 logger.error("Нет доступных inbounds для создания пользователя")
                 return None
 
-            base_inbound = inbounds[0]
-            port = self.find_free_port()
-
-            settings = base_inbound.get("settings", {})
-            if isinstance(settings, str):
+            for attempt in range(2):
+                port = await self.find_free_port()
                 try:
-                    settings = json.loads(settings)
+                    new_inbound = self._build_user_inbound(
+                        inbounds[0], client_id, email, port, traffic_gb, expire_timestamp
+                    )
                 except json.JSONDecodeError:
+                    self.ports.release(port)
                     logger.error("Не удалось декодировать настройки inbound")
                     return None
 
-            clients = []
-            clients.append({
-                "id": client_id,
-                "flow": "xtls-rprx-vision",
-                "email": email,
-                "limitIp": 0,
-                "totalGB": traffic_gb,
-                "expiryTime": expire_timestamp
-            })
-
-            settings["clients"] = clients
-            base_inbound["settings"] = settings
-            base_inbound["port"] = port
-            base_inbound["expiryTime"] = expire_timestamp
-            base_inbound.pop("id", None)
-            base_inbound.pop("inbound_id", None)
-
-            for field in ["settings", "streamSettings", "sniffing", "allocate"]:
-                if field in base_inbound and isinstance(base_inbound[field], dict):
-                    base_inbound[field] = json.dumps(base_inbound[field])
-
-            result = self.create_inbound(base_inbound)
-            if result.get("success"):
-                logger.info(f"Пользователь успешно создан: {client_id}, порт: {port}")
-                return client_id, port
+                result = await self.create_inbound(self._serialize_inbound(new_inbound))
+                if result.get("success"):
+                    self.ports.confirm(port)
+                    self._cache_created_inbound(result)
+                    logger.info("Пользователь успешно создан: %s, порт: %s", client_id, port)
+                    return client_id, port
 
-            logger.error(f"Ошибка создания пользователя: {result.get('msg', 'Неизвестная ошибка')}")
+                self.ports.release(port)
+                if attempt or not self._is_port_conflict(result):
+                    break
+                logger.warning("Порт %s уже занят в панели, пул портов будет перестроен", port)
+                await self._rebuild_ports()
+
+            logger.error("Ошибка создания пользователя: %s", result.get('msg', 'Неизвестная ошибка'))
             return None
 
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при создании пользователя: {str(e)}")
+            logger.error("Неожиданная ошибка при создании пользователя: %s", e)
             return None
 
-    def update_user(self, uuid, traffic_gb=None, expire_days=None):
-        try:
-            logger.info(f"Обновление пользователя {uuid}: трафик={traffic_gb}GB, дней={expire_days}")
-
-            inbounds = self.get_inbounds()
-            for inbound in inbounds:
-                settings = inbound.get("settings", {})
-                if isinstance(settings, str):
-                    settings = json.loads(settings)
-
-                clients = settings.get("clients", [])
-                for client in clients:
-                    if client.get("id") == uuid:
-                        updated = False
-
-                        if traffic_gb is not None:
-                            client["totalGB"] = traffic_gb
-                            updated = True
-
-                        if expire_days is not None:
-                            new_expire = int((datetime.now() + timedelta(days=expire_days)).timestamp() * 1000)
-                            client["expiryTime"] = new_expire
-                            inbound["expiryTime"] = new_expire
-                            updated = True
-
-                        if not updated:
-                            logger.warning("Нет изменений для обновления")
-                            return False
-
-                        settings["clients"] = clients
-                        inbound["settings"] = settings
-                        update_data = {k: v for k, v in inbound.items() if k not in ["id", "inbound_id"]}
-
-                        result = self.update_inbound(inbound["id"], update_data)
-                        return result.get("success", False)
+    async def _create_shared_client(self, client_id, email, traffic_gb, expire_timestamp):
+        # Под _modify_lock: пакет, отправляющий общий inbound целиком, иначе затёр бы нового клиента
+        async with self._modify_lock.shared():
+            inbound = self._pick_shared_inbound()
+            if inbound is None:
+                logger.error("Нет общих inbounds со свободным местом для нового клиента")
+                return None
 
-            logger.warning(f"Пользователь {uuid} не найден для обновления")
-            return False
+            client = self._new_client(client_id, email, traffic_gb, expire_timestamp)
+            self._cache_client(inbound, client)
+            result = await self.add_client(inbound["id"], client)
+        if result.get("success"):
+            logger.info("Пользователь успешно создан: %s, inbound: %s, порт: %s", client_id, inbound['id'], inbound['port'])
+            return client_id, inbound["port"]
 
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при обновлении пользователя {uuid}: {str(e)}")
-            return False
+        current = self.index.get(inbound["id"])
+        if current is not None:
+            self._cache_client(current, remove_uuid=client_id)
+        logger.error("Ошибка создания пользователя: %s", result.get('msg', 'Неизвестная ошибка'))
+        return None
 
-    def delete_user(self, uuid):
+    async def delete_user(self, uuid):
         try:
-            logger.info(f"Попытка удаления пользователя {uuid}")
-
-            inbounds = self.get_inbounds()
-            for inbound in inbounds:
-                settings = inbound.get("settings", {})
-                if isinstance(settings, str):
-                    settings = json.loads(settings)
-
-                clients = settings.get("clients", [])
-                for client in clients:
-                    if client.get("id") == uuid:
-                        result = self.del_inbound(inbound["id"])
-                        return result.get("success", False)
-
-            logger.warning(f"Пользователь {uuid} не найден для удаления")
+            logger.info("Попытка удаления пользователя %s", uuid)
+
+            inbound = await self._find_user_inbound(uuid)
+            if inbound is None:
+                logger.warning("Пользователь %s не найден для удаления", uuid)
+                return False
+
+            if self._is_shared(inbound):
+                async with self._modify_lock.shared():
+                    result = await self.del_client(inbound["id"], uuid)
+                if result.get("success"):
+                    self._cache_client(self.index.get(inbound["id"]) or inbound, remove_uuid=uuid)
+                    return True
+            else:
+                result = await self.del_inbound(inbound["id"])
+                if result.get("success"):
+                    self.index.remove(inbound["id"])
+                    self.ports.release(inbound.get("port"))
+                    return True
+
+            self.index.invalidate()
             return False
 
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при удалении пользователя {uuid}: {str(e)}")
+            logger.error("Неожиданная ошибка при удалении пользователя %s: %s", uuid, e)
             return False
 
-    def generate_config(self, uuid, port):
-        config = (
-            f"vless://{uuid}@divan4ikbmstu.online:{port}?"
-            f"encryption=none&flow=xtls-rprx-vision&security=tls&"
-            f"sni=divan4ikbmstu.online&fp=chrome&"
-            f"type=tcp&headerType=none#{uuid[:8]}"
-        )
-        logger.debug(f"Сгенерирована конфигурация для {uuid}")
-        return config
-
-    def get_server_stats(self):
-        try:
-            cpu_percent = psutil.cpu_percent()
-            ram = psutil.virtual_memory()
-
-            inbounds = self.get_inbounds()
-            total_up = sum(inb.get("up", 0) for inb in inbounds)
-            total_down = sum(inb.get("down", 0) for inb in inbounds)
-
-            stats = {
-                "cpu": cpu_percent,
-                "ram": ram.percent,
-                "upload": total_up / (1024 ** 3),
-                "download": total_down / (1024 ** 3),
-                "connections": len(inbounds)
-            }
-
-            logger.debug(f"Статистика сервера: {stats}")
-            return stats
-
-        except Exception as e:
-            logger.error(f"Ошибка получения статистики сервера: {str(e)}")
-            return {
-                "cpu": 0, "ram": 0, "upload": 0, "download": 0, "connections": 0
-            }
-
-    def find_free_port(self, start=21000, end=30000):
-        try:
-            used_ports = {inb.get("port") for inb in self.get_inbounds()}
-            for port in range(start, end):
-                if port not in used_ports:
-                    logger.debug(f"Найден свободный порт: {port}")
-                    return port
-
-            logger.error("Не найдено свободных портов в указанном диапазоне")
-            raise RuntimeError("Свободный порт не найден")
-
-        except Exception as e:
-            logger.error(f"Ошибка поиска свободного порта: {str(e)}")
-            raise
-
-    def check_connection(self):
-        if not self._login():
-            logger.error("Проверка соединения: ошибка аутентификации")
-            return "❌ Ошибка аутентификации"
-
-        result = self._request("GET", "/panel/api/inbounds/list")
-        if result.get("success"):
-            logger.info("Проверка соединения: успешно")
-            return "✅ Соединение с X-UI установлено"
-
-        error_msg = result.get("msg", "Неизвестная ошибка")
-        logger.error(f"Проверка соединения: ошибка - {error_msg}")
-        return f"❌ Ошибка соединения: {error_msg}"
\ No newline at end of file
+    async def get_client_traffic(self):
+        await self.get_inbounds(force=True)
+        if not self.index.is_fresh():
+            logger.error("Не удалось получить трафик клиентов")
+            return None
+        usage = self._collect_client_traffic()
+        logger.debug("Получен трафик %s клиентов", len(usage))
+        return usage
+
+    async def _modify_clients(self, uuids, mutate, concurrency):
+        # Пакет отправляет общий inbound целиком, поэтому он исключает и другие пакеты, и одиночные
+        # addClient/delClient: изменение, попавшее между чтением и записью, было бы затёрто
+        async with self._modify_lock.exclusive():
+            return await self._modify_batch(uuids, mutate, concurrency)
+
+    async def _modify_batch(self, uuids, mutate, concurrency):
+        # Один запрос update на inbound, сколько бы его клиентов ни менялось. Inbound уходит в панель
+        # целиком (все клиенты, счётчики up/down), поэтому список перечитывается один раз на пакет:
+        # снимок из кэша затёр бы клиентов, отключённых или добавленных панелью за время жизни кэша
+        await self.get_inbounds(force=True)
+        if not self.index.is_fresh():
+            logger.error("Не удалось получить inbounds для изменения клиентов")
+            return set(), []
+
+        groups, missing = self._group_by_inbound(uuids)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def apply(inbound_id, group):
+            async with semaphore:
+                inbound = copy.deepcopy(self.index.get(inbound_id))
+                for uuid in group:
+                    mutate(inbound, uuid)
+                result = await self.update_inbound(inbound_id, self._serialize_inbound(inbound))
+                if result.get("success"):
+                    self.index.put(inbound)
+                    return group
+                return []
+
+        results = await asyncio.gather(*(apply(i, g) for i, g in groups.items()))
+        done = set()
+        for group in results:
+            done.update(group)
+        if len(done) + len(missing) < len(uuids):
+            self.index.invalidate()
+        logger.info("Изменено клиентов: %s из %s, запросов к панели: %s", len(done), len(uuids), len(groups))
+        return done, missing
+
+    async def disable_clients(self, uuids, concurrency=5):
+        def disable(inbound, uuid):
+            self._get_client(inbound, uuid)["enable"] = False
+            if not self._is_shared(inbound):
+                inbound["enable"] = False
+
+        disabled, missing = await self._modify_clients(uuids, disable, concurrency)
+        if missing:
+            logger.warning("Клиенты не найдены в панели, считаются отключенными: %s", len(missing))
+        return disabled | set(missing)
+
+    async def update_clients(self, changes, concurrency=5):
+        # changes: {uuid: (traffic_gb, expiry_time)}, expiry_time — абсолютный срок в секундах
+        def renew(inbound, uuid):
+            traffic_gb, expiry_time = changes[uuid]
+            self._apply_client_update(inbound, uuid, traffic_gb, expiry_time=expiry_time)
+
+        updated, missing = await self._modify_clients(list(changes), renew, concurrency)
+        if missing:
+            logger.warning("Клиенты не найдены в панели для обновления: %s", len(missing))
+        return updated, missing
+
+    async def delete_clients(self, uuids, concurrency=5):
+        await self.get_inbounds(force=True)
+        if not self.index.is_fresh():
+            logger.error("Не удалось получить inbounds для удаления клиентов")
+            return set()
+
+        # Клиента, которого уже нет в свежем индексе, удалять не нужно
+        groups, missing = self._group_by_inbound(uuids)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def delete(uuid):
+            async with semaphore:
+                return uuid if await self.delete_user(uuid) else None
+
+        results = await asyncio.gather(*(delete(uuid) for group in groups.values() for uuid in group))
+        return {uuid for uuid in results if uuid is not None} | set(missing)
+
+    async def find_free_port(self):
+        if not self.ports.ready:
+            async with self._ports_lock:
+                if not self.ports.ready:
+                    await self._rebuild_ports()
+        return self.ports.reserve()
+
+    async def _rebuild_ports(self):
+        await self.get_inbounds(force=True)
+        if not self.index.is_fresh():
+            raise RuntimeError("Не удалось получить занятые порты из панели")
+        self.ports.rebuild(self.index.used_ports())
+
+    async def is_healthy(self, force=False):
+        # Кэшированная проверка: панель опрашивается не чаще раза в health_ttl секунд,
+        # а прогретый индекс inbounds делает её бесплатной
+        if not force and self._health is not None and time.monotonic() - self._health[0] < self.health_ttl:
+            return self._health[1]
+
+        healthy = await self.ensure_session()
+        if healthy:
+            await self.get_inbounds()
+            healthy = self.index.is_fresh()
+        self._health = (time.monotonic(), healthy)
+        if not healthy:
+            logger.warning("Проверка состояния X-UI: панель недоступна")
+        return healthy